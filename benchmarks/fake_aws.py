@@ -0,0 +1,535 @@
+"""
+In-process stand-ins for the S3, CloudFormation and EC2 clients used by the services.
+
+The fake clients implement the subset of the boto3 client API used by the services, keep their state in memory
+and emulate the time aspects that matter for performance: a fixed latency per HTTP request, random throttling
+(retried like the adaptive retry mode of the real clients), stack creation/deletion time and instance boot time.
+They fire the botocore client events used by aws_common.metrics, so the service metrics count their calls.
+"""
+import base64
+import datetime
+import hashlib
+import json
+import random
+import StringIO
+import threading
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+from botocore.exceptions import ClientError
+from aws_common.templates import parse_s3_url
+
+LIST_PAGE_SIZE = 1000
+CF_PAGE_SIZE = 100
+## objects up to this size keep their content, larger objects only keep their size (files are created sparse on download)
+STORED_DATA_LIMIT = 1024 * 1024
+THROTTLING_CODES = {'s3': 'SlowDown', 'cloudformation': 'Throttling', 'ec2': 'RequestLimitExceeded'}
+RETRY_BASE_DELAY = 0.05
+RETRY_MAX_DELAY = 2
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+_zero_digests = {}
+
+
+def zero_digest(size):
+    if size not in _zero_digests:
+        _zero_digests[size] = hashlib.md5('\0' * size).digest()
+    return _zero_digests[size]
+
+
+def zero_etag(size, part_size=DEFAULT_PART_SIZE):
+    ## the etag of an object of zeros uploaded with the default part size (objects stored without their content)
+    if size <= part_size:
+        return zero_digest(size).encode('hex')
+    digests = [zero_digest(part_size)] * (size // part_size)
+    if size % part_size:
+        digests.append(zero_digest(size % part_size))
+    return '%s-%d' % (hashlib.md5(''.join(digests)).hexdigest(), len(digests))
+
+
+class FakeEvents(object):
+
+    def __init__(self):
+        self.handlers = []
+
+    def register(self, event_name, handler):
+        self.handlers.append((event_name, handler))
+
+    def emit(self, event_name, **kwargs):
+        for name, handler in self.handlers:
+            if event_name == name or event_name.startswith(name + '.'):
+                handler(**kwargs)
+
+
+class FakeOperationModel(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeServiceModel(object):
+
+    def __init__(self, service_name):
+        self.service_name = service_name
+
+
+class FakeClientMeta(object):
+
+    def __init__(self, service_name, region):
+        self.events = FakeEvents()
+        self.service_model = FakeServiceModel(service_name)
+        self.region_name = region
+
+
+class ZeroStream(object):
+    """
+    A streaming body of zeros, used for objects stored without their content.
+    """
+
+    def __init__(self, size):
+        self.remaining = size
+
+    def read(self, amt=None):
+        amt = self.remaining if amt is None else min(amt, self.remaining)
+        self.remaining -= amt
+        return '\0' * amt
+
+    def close(self):
+        pass
+
+
+class FakeAWS(object):
+    """
+    The shared state of all fake clients, and the get_client replacement handed to the services.
+    """
+
+    def __init__(self, latency=0.02, throttle_rate=0.0, max_attempts=10, stack_time=20, delete_time=10,
+                 boot_time=10, seed=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.max_attempts = max_attempts
+        self.stack_time = stack_time
+        self.delete_time = delete_time
+        self.boot_time = boot_time
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.buckets = {}
+        self.stacks = {}
+        self.instances = {}
+        self.multipart_uploads = {}
+        self.requests = {}
+        self.throttles = 0
+        self.clients = {}
+
+    def get_client(self, service_name, aws_access_key=None, aws_secret_key=None, region=None, max_pool_connections=None):
+        key = (service_name, region)
+        with self.lock:
+            if key not in self.clients:
+                client_class = {'s3': FakeS3Client, 'cloudformation': FakeCloudFormationClient, 'ec2': FakeEC2Client}[service_name]
+                self.clients[key] = client_class(self, region or 'us-east-1')
+            return self.clients[key]
+
+    def request(self, service_name, operation):
+        ## one http request: waits the request latency and decides if it is throttled
+        time.sleep(self.latency)
+        with self.lock:
+            key = '%s.%s' % (service_name, operation)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            throttled = self.random.random() < self.throttle_rate
+            if throttled:
+                self.throttles += 1
+        return throttled
+
+    def total_requests(self):
+        return sum(self.requests.values())
+
+    def put_object(self, bucket, key, size, data=None, etag=None, content_type=None):
+        with self.lock:
+            self.buckets.setdefault(bucket, {})[key] = {
+                'size': size,
+                'data': data,
+                'etag': etag or (hashlib.md5(data).hexdigest() if data is not None else zero_etag(size)),
+                'content_type': content_type or 'binary/octet-stream',
+                'last_modified': datetime.datetime.utcnow()
+            }
+
+    def agent_ready(self, agent_name, checkin_time):
+        ## an agent checks in once its instance has been running for checkin_time seconds
+        now = time.time()
+        with self.lock:
+            for instance in self.instances.values():
+                if instance['tags'].get('OperetoAgentId') == agent_name:
+                    return instance['running_at'] + checkin_time <= now
+        return False
+
+
+class FakeClient(object):
+    service_name = None
+
+    def __init__(self, aws, region):
+        self.aws = aws
+        self.region = region
+        self.meta = FakeClientMeta(self.service_name, region)
+
+    def _call(self, operation, func, *args, **kwargs):
+        self.meta.events.emit('before-call.%s.%s' % (self.service_name, operation), model=FakeOperationModel(operation))
+        attempts = 0
+        while True:
+            attempts += 1
+            self.meta.events.emit('before-send.%s.%s' % (self.service_name, operation))
+            if not self.aws.request(self.service_name, operation):
+                return func(*args, **kwargs)
+            response = {'Error': {'Code': THROTTLING_CODES[self.service_name], 'Message': 'Rate exceeded'}}
+            self.meta.events.emit('needs-retry.%s.%s' % (self.service_name, operation), response=(None, response), attempts=attempts)
+            if attempts >= self.aws.max_attempts:
+                raise ClientError(response, operation)
+            time.sleep(min(RETRY_BASE_DELAY * 2 ** attempts, RETRY_MAX_DELAY) * random.random())
+
+    def _error(self, operation, code, message, status=400):
+        return ClientError({'Error': {'Code': code, 'Message': message}, 'ResponseMetadata': {'HTTPStatusCode': status}}, operation)
+
+    def _check_content_md5(self, operation, digest, content_md5):
+        if content_md5 and base64.b64encode(digest) != content_md5:
+            raise self._error(operation, 'BadDigest', 'The Content-MD5 you specified did not match what we received.')
+
+
+class FakePaginator(object):
+
+    def __init__(self, page_func):
+        self.page_func = page_func
+
+    def paginate(self, **kwargs):
+        token = None
+        while True:
+            page = self.page_func(ContinuationToken=token, **kwargs)
+            yield page
+            token = page.get('NextContinuationToken')
+            if not token:
+                break
+
+
+class FakeS3Client(FakeClient):
+    service_name = 's3'
+
+    def _object(self, operation, bucket, key):
+        obj = self.aws.buckets.get(bucket, {}).get(key)
+        if obj is None:
+            raise self._error(operation, '404', 'Not Found', 404)
+        return obj
+
+    def create_bucket(self, Bucket, **kwargs):
+        def create():
+            with self.aws.lock:
+                self.aws.buckets.setdefault(Bucket, {})
+            return {'Location': '/%s' % Bucket}
+        return self._call('CreateBucket', create)
+
+    def head_object(self, Bucket, Key, **kwargs):
+        def head():
+            obj = self._object('HeadObject', Bucket, Key)
+            return {'ContentLength': obj['size'], 'ETag': '"%s"' % obj['etag'], 'ContentType': obj['content_type'],
+                    'LastModified': obj['last_modified']}
+        return self._call('HeadObject', head)
+
+    def put_object(self, Bucket, Key, Body='', **kwargs):
+        def put():
+            data = Body.read() if hasattr(Body, 'read') else Body
+            self._check_content_md5('PutObject', hashlib.md5(data).digest(), kwargs.get('ContentMD5'))
+            self.aws.put_object(Bucket, Key, len(data), data=data, content_type=kwargs.get('ContentType'))
+            return {'ETag': '"%s"' % self.aws.buckets[Bucket][Key]['etag']}
+        return self._call('PutObject', put)
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        def get():
+            obj = self._object('GetObject', Bucket, Key)
+            start, end = 0, obj['size'] - 1
+            if Range:
+                start, end = [int(value) for value in Range.split('=')[1].split('-')]
+                end = min(end, obj['size'] - 1)
+            length = end - start + 1
+            body = StringIO.StringIO(obj['data'][start:end + 1]) if obj['data'] is not None else ZeroStream(length)
+            return {'Body': body, 'ContentLength': length, 'ETag': '"%s"' % obj['etag'], 'ContentType': obj['content_type']}
+        return self._call('GetObject', get)
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        def delete():
+            with self.aws.lock:
+                for obj in Delete['Objects']:
+                    self.aws.buckets.get(Bucket, {}).pop(obj['Key'], None)
+            return {'Deleted': Delete['Objects'], 'Errors': []}
+        return self._call('DeleteObjects', delete)
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None, **kwargs):
+        def list_objects():
+            keys = sorted([key for key in self.aws.buckets.get(Bucket, {}) if key.startswith(Prefix)])
+            if ContinuationToken:
+                keys = [key for key in keys if key > ContinuationToken]
+            page = keys[:LIST_PAGE_SIZE]
+            result = {'Contents': [{'Key': key, 'Size': self.aws.buckets[Bucket][key]['size'],
+                                    'ETag': '"%s"' % self.aws.buckets[Bucket][key]['etag'],
+                                    'LastModified': self.aws.buckets[Bucket][key]['last_modified']} for key in page]}
+            if len(keys) > LIST_PAGE_SIZE:
+                result['NextContinuationToken'] = page[-1]
+            return result
+        return self._call('ListObjectsV2', list_objects)
+
+    def get_paginator(self, operation_name):
+        return FakePaginator({'list_objects_v2': self.list_objects_v2}[operation_name])
+
+    def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=3600):
+        return 'https://%s.s3.amazonaws.com/%s?X-Amz-Expires=%d' % (Params['Bucket'], Params['Key'], ExpiresIn)
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        def copy():
+            obj = self._object('CopyObject', CopySource['Bucket'], CopySource['Key'])
+            self.aws.put_object(Bucket, Key, obj['size'], data=obj['data'], etag=obj['etag'], content_type=obj['content_type'])
+            return {'CopyObjectResult': {'ETag': '"%s"' % obj['etag']}}
+        return self._call('CopyObject', copy)
+
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber, CopySource, CopySourceRange, **kwargs):
+        def copy_part():
+            obj = self._object('UploadPartCopy', CopySource['Bucket'], CopySource['Key'])
+            start, end = [int(value) for value in CopySourceRange.split('=')[1].split('-')]
+            digest = hashlib.md5(obj['data'][start:end + 1]).digest() if obj['data'] is not None else zero_digest(end - start + 1)
+            with self.aws.lock:
+                self.aws.multipart_uploads[UploadId]['parts'][PartNumber] = end - start + 1
+            return {'CopyPartResult': {'ETag': '"%s"' % digest.encode('hex')}}
+        return self._call('UploadPartCopy', copy_part)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        def create():
+            upload_id = uuid.uuid4().hex
+            with self.aws.lock:
+                self.aws.multipart_uploads[upload_id] = {'parts': {}, 'content_type': kwargs.get('ContentType')}
+            return {'UploadId': upload_id}
+        return self._call('CreateMultipartUpload', create)
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        def upload():
+            if isinstance(Body, ZeroBody):
+                size, digest = len(Body), zero_digest(len(Body))
+            else:
+                data = Body.read() if hasattr(Body, 'read') else Body
+                size, digest = len(data), hashlib.md5(data).digest()
+            self._check_content_md5('UploadPart', digest, kwargs.get('ContentMD5'))
+            with self.aws.lock:
+                self.aws.multipart_uploads[UploadId]['parts'][PartNumber] = size
+            return {'ETag': '"%s"' % digest.encode('hex')}
+        return self._call('UploadPart', upload)
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload=None, **kwargs):
+        def complete():
+            with self.aws.lock:
+                upload = self.aws.multipart_uploads.pop(UploadId)
+            parts = upload['parts']
+            ## the etag of a multipart upload is the md5 of its part md5s
+            etag = '%s-%d' % (hashlib.md5(''.join([part['ETag'].strip('"').decode('hex') for part in MultipartUpload['Parts']])).hexdigest(), len(parts))
+            self.aws.put_object(Bucket, Key, sum(parts.values()), etag=etag, content_type=upload['content_type'])
+            return {'ETag': '"%s"' % etag}
+        return self._call('CompleteMultipartUpload', complete)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        def abort():
+            with self.aws.lock:
+                self.aws.multipart_uploads.pop(UploadId, None)
+            return {}
+        return self._call('AbortMultipartUpload', abort)
+
+    def _parts(self, size, config):
+        chunksize = config.multipart_chunksize if config else 8 * 1024 * 1024
+        return [(start, min(start + chunksize, size)) for start in range(0, size, chunksize)]
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Config=None, Callback=None):
+        ## the transfer manager: a single put below the multipart threshold, otherwise parallel parts
+        ExtraArgs = ExtraArgs or {}
+        with open(Filename, 'rb') as f:
+            f.seek(0, 2)
+            size = f.tell()
+            threshold = Config.multipart_threshold if Config else 8 * 1024 * 1024
+            if size < threshold:
+                f.seek(0)
+                data = f.read() if size <= STORED_DATA_LIMIT else None
+                if data is not None:
+                    return self.put_object(Bucket=Bucket, Key=Key, Body=data, **ExtraArgs)
+                return self._call('PutObject', self.aws.put_object, Bucket, Key, size, content_type=ExtraArgs.get('ContentType'))
+
+        upload_id = self.create_multipart_upload(Bucket=Bucket, Key=Key, **ExtraArgs)['UploadId']
+
+        def upload_part(part):
+            ## part content is not kept, only its size
+            number, (start, end) = part
+            return self.upload_part(Bucket=Bucket, Key=Key, UploadId=upload_id, PartNumber=number, Body=ZeroBody(end - start))['ETag']
+
+        pool = ThreadPool(Config.max_concurrency if Config else 10)
+        try:
+            etags = pool.map(upload_part, list(enumerate(self._parts(size, Config), 1)))
+        finally:
+            pool.close()
+            pool.join()
+        self.complete_multipart_upload(Bucket=Bucket, Key=Key, UploadId=upload_id,
+                                       MultipartUpload={'Parts': [{'ETag': etag, 'PartNumber': number} for number, etag in enumerate(etags, 1)]})
+
+    def download_file(self, Bucket, Key, Filename, ExtraArgs=None, Config=None, Callback=None):
+        size = self.head_object(Bucket=Bucket, Key=Key)['ContentLength']
+        threshold = Config.multipart_threshold if Config else 8 * 1024 * 1024
+        obj = self.aws.buckets[Bucket][Key]
+        with open(Filename, 'wb') as f:
+            if size < threshold:
+                f.write(self.get_object(Bucket=Bucket, Key=Key)['Body'].read())
+                return
+            pool = ThreadPool(Config.max_concurrency if Config else 10)
+            try:
+                ## ranged gets are only timed, the file content is written at once
+                pool.map(lambda part: self._call('GetObject', lambda: None), self._parts(size, Config))
+            finally:
+                pool.close()
+                pool.join()
+            if obj['data'] is not None:
+                f.write(obj['data'])
+            else:
+                f.truncate(size)
+
+
+class ZeroBody(object):
+    """
+    A part body that only has a length.
+    """
+
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+class FakeCloudFormationClient(FakeClient):
+    service_name = 'cloudformation'
+
+    def _stack(self, operation, stack_name):
+        for stack in self.aws.stacks.values():
+            if stack['StackId'] == stack_name or (stack['StackName'] == stack_name and not stack.get('deleted')):
+                return stack
+        raise self._error(operation, 'ValidationError', 'Stack with id %s does not exist' % stack_name)
+
+    def _status(self, stack):
+        ## stack status is derived from the time its operation started
+        now = time.time()
+        if stack.get('delete_started'):
+            return 'DELETE_COMPLETE' if now >= stack['delete_started'] + self.aws.delete_time else 'DELETE_IN_PROGRESS'
+        return 'CREATE_COMPLETE' if now >= stack['created'] + self.aws.stack_time else 'CREATE_IN_PROGRESS'
+
+    def _describe(self, stack):
+        return {'StackId': stack['StackId'], 'StackName': stack['StackName'], 'StackStatus': self._status(stack),
+                'Tags': stack['Tags'], 'Outputs': [], 'CreationTime': datetime.datetime.utcfromtimestamp(stack['created'])}
+
+    def _events(self, stack):
+        status = self._status(stack)
+        events = [(stack['created'], stack['StackName'], 'CREATE_IN_PROGRESS')]
+        if status != 'CREATE_IN_PROGRESS':
+            completed = stack['created'] + self.aws.stack_time
+            events += [(completed, logical_id, 'CREATE_COMPLETE') for logical_id in sorted(stack['resources'])]
+            events.append((completed, stack['StackName'], 'CREATE_COMPLETE'))
+        if stack.get('delete_started'):
+            events.append((stack['delete_started'], stack['StackName'], 'DELETE_IN_PROGRESS'))
+            if status == 'DELETE_COMPLETE':
+                events.append((stack['delete_started'] + self.aws.delete_time, stack['StackName'], 'DELETE_COMPLETE'))
+        return [{'EventId': '%s-%d' % (logical_id, i), 'StackId': stack['StackId'], 'LogicalResourceId': logical_id,
+                 'ResourceStatus': resource_status, 'Timestamp': datetime.datetime.utcfromtimestamp(timestamp)}
+                for i, (timestamp, logical_id, resource_status) in reversed(list(enumerate(events)))]
+
+    def _page(self, items, next_token):
+        start = int(next_token or 0)
+        page = items[start:start + CF_PAGE_SIZE]
+        token = str(start + CF_PAGE_SIZE) if start + CF_PAGE_SIZE < len(items) else None
+        return page, token
+
+    def validate_template(self, TemplateBody=None, TemplateURL=None):
+        def validate():
+            if TemplateBody is not None:
+                json.loads(TemplateBody)
+            return {'Parameters': [], 'Capabilities': []}
+        return self._call('ValidateTemplate', validate)
+
+    def create_stack(self, StackName, TemplateBody=None, TemplateURL=None, Tags=None, **kwargs):
+        def create():
+            if TemplateURL:
+                bucket, key = parse_s3_url(TemplateURL)
+                template = json.loads(self.aws.buckets[bucket][key]['data'])
+            else:
+                template = json.loads(TemplateBody)
+            stack_id = 'arn:aws:cloudformation:%s:000000000000:stack/%s/%s' % (self.region, StackName, uuid.uuid4())
+            created = time.time()
+            resources = {}
+            with self.aws.lock:
+                for logical_id, resource in template.get('Resources', {}).items():
+                    physical_id = '%s-%s' % (logical_id, uuid.uuid4().hex[:8])
+                    if resource['Type'] == 'AWS::EC2::Instance':
+                        physical_id = 'i-%s' % uuid.uuid4().hex[:17]
+                        tags = dict([(tag['Key'], tag['Value']) for tag in resource.get('Properties', {}).get('Tags', [])])
+                        self.aws.instances[physical_id] = {'tags': tags, 'running_at': created + self.aws.stack_time + self.aws.boot_time}
+                    resources[logical_id] = {'type': resource['Type'], 'physical_id': physical_id}
+                self.aws.stacks[stack_id] = {'StackId': stack_id, 'StackName': StackName, 'Tags': Tags or [],
+                                             'created': created, 'resources': resources, 'region': self.region}
+            return {'StackId': stack_id}
+        return self._call('CreateStack', create)
+
+    def delete_stack(self, StackName, **kwargs):
+        def delete():
+            stack = self._stack('DeleteStack', StackName)
+            stack.setdefault('delete_started', time.time())
+            return {}
+        return self._call('DeleteStack', delete)
+
+    def describe_stacks(self, StackName=None, NextToken=None):
+        def describe():
+            if StackName:
+                return {'Stacks': [self._describe(self._stack('DescribeStacks', StackName))]}
+            stacks = [self._describe(stack) for stack in sorted(self.aws.stacks.values(), key=lambda s: s['created'])
+                      if stack['region'] == self.region and self._status(stack) != 'DELETE_COMPLETE']
+            page, token = self._page(stacks, NextToken)
+            return dict({'Stacks': page}, **({'NextToken': token} if token else {}))
+        return self._call('DescribeStacks', describe)
+
+    def list_stacks(self, NextToken=None, **kwargs):
+        def list_summaries():
+            summaries = [{'StackId': stack['StackId'], 'StackName': stack['StackName'], 'StackStatus': self._status(stack)}
+                         for stack in sorted(self.aws.stacks.values(), key=lambda s: s['created']) if stack['region'] == self.region]
+            page, token = self._page(summaries, NextToken)
+            return dict({'StackSummaries': page}, **({'NextToken': token} if token else {}))
+        return self._call('ListStacks', list_summaries)
+
+    def describe_stack_events(self, StackName, NextToken=None):
+        def describe():
+            page, token = self._page(self._events(self._stack('DescribeStackEvents', StackName)), NextToken)
+            return dict({'StackEvents': page}, **({'NextToken': token} if token else {}))
+        return self._call('DescribeStackEvents', describe)
+
+    def list_stack_resources(self, StackName, NextToken=None):
+        def list_resources():
+            stack = self._stack('ListStackResources', StackName)
+            resources = [{'LogicalResourceId': logical_id, 'PhysicalResourceId': resource['physical_id'], 'ResourceType': resource['type']}
+                         for logical_id, resource in sorted(stack['resources'].items())]
+            page, token = self._page(resources, NextToken)
+            return dict({'StackResourceSummaries': page}, **({'NextToken': token} if token else {}))
+        return self._call('ListStackResources', list_resources)
+
+
+class FakeEC2Client(FakeClient):
+    service_name = 'ec2'
+
+    def describe_instances(self, InstanceIds=None, **kwargs):
+        def describe():
+            now = time.time()
+            instances = []
+            for instance_id in InstanceIds or sorted(self.aws.instances):
+                instance = self.aws.instances[instance_id]
+                instances.append({
+                    'InstanceId': instance_id,
+                    'InstanceType': 't2.micro',
+                    'State': {'Name': 'running' if now >= instance['running_at'] else 'pending'},
+                    'PrivateIpAddress': '127.0.0.1',
+                    'Placement': {'AvailabilityZone': '%sa' % self.region},
+                    'Tags': [{'Key': key, 'Value': value} for key, value in instance['tags'].items()]
+                })
+            return {'Reservations': [{'Instances': instances}]}
+        return self._call('DescribeInstances', describe)
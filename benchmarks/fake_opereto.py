@@ -0,0 +1,52 @@
+"""
+A stand-in for the opereto client of a service process, with a fixed latency per server call.
+"""
+import threading
+import time
+import uuid
+
+
+class FakeOperetoClient(object):
+    SUCCESS = 'success'
+    FAILURE = 'failure'
+    ERROR = 'error'
+
+    def __init__(self, aws, latency=0.01, agent_checkin_time=5, install_time=2):
+        self.aws = aws
+        self.latency = latency
+        self.agent_checkin_time = agent_checkin_time
+        self.install_time = install_time
+        self.input = {'opereto_originator_username': 'benchmark'}
+        self.properties = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def _call(self, name):
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def modify_process_property(self, key, value, pid=None):
+        self._call('modify_process_property')
+        self.properties[key] = value
+
+    def get_agent_properties(self, agent_name):
+        self._call('get_agent_properties')
+        if not self.aws.agent_ready(agent_name, self.agent_checkin_time):
+            raise Exception('Agent %s does not exist' % agent_name)
+        return {}
+
+    def modify_agent_properties(self, agent_name, properties):
+        self._call('modify_agent_properties')
+
+    def modify_agent(self, agent_name, **kwargs):
+        self._call('modify_agent')
+
+    def create_process(self, service, agent=None, title=None, **kwargs):
+        self._call('create_process')
+        return uuid.uuid4().hex
+
+    def is_success(self, pids):
+        self._call('is_success')
+        time.sleep(self.install_time)
+        return True
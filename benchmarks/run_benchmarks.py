@@ -0,0 +1,257 @@
+"""
+Runs the services against the in-process AWS and opereto stand-ins and reports wall time, throughput and API calls.
+
+    python benchmarks/run_benchmarks.py [scenario ...] [--latency MS] [--throttle-rate RATE] [--scale SCALE] [--json FILE]
+
+The services run unchanged: only their get_client (and the ubuntu check) are replaced in the service module,
+and the runner is given a fake opereto client. The opereto python client, boto3 and botocore must be installed.
+"""
+import argparse
+import imp
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+SERVICES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'services')
+sys.path.insert(0, SERVICES_DIR)
+from fake_aws import FakeAWS
+from fake_opereto import FakeOperetoClient
+from aws_common.manifest import write_manifest
+
+MB = 1024 * 1024
+GB = 1024 * MB
+BUCKET = 'opereto-benchmark'
+
+CREDENTIALS = {
+    'aws_access_key': 'benchmark-access-key',
+    'aws_secret_key': 'benchmark-secret-key'
+}
+
+
+def load_service(service_name, aws):
+    module = imp.load_source('%s_run' % service_name, os.path.join(SERVICES_DIR, service_name, 'run.py'))
+    module.get_client = aws.get_client
+    module.raise_if_not_ubuntu = lambda: None
+    return module
+
+
+def run_service(service_name, inputs, aws, opereto_client):
+    ## follows the service template flow: setup, input validation, process and teardown
+    module = load_service(service_name, aws)
+    runner = module.ServiceRunner.__new__(module.ServiceRunner)
+    runner.input = inputs
+    runner.client = opereto_client
+    started = time.time()
+    try:
+        runner.setup()
+        runner.validate_input()
+        result = runner.process()
+    except Exception, e:
+        print >> sys.stderr, '%s failed: %s' % (service_name, str(e))
+        result = opereto_client.ERROR
+    finally:
+        runner.teardown()
+    return result, time.time() - started
+
+
+def write_files(path, count, size):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for i in range(count):
+        with open(os.path.join(path, 'file-%06d.dat' % i), 'wb') as f:
+            if size <= MB:
+                f.write(os.urandom(size))
+            else:
+                ## large files are sparse, the stand-in does not keep their content
+                f.truncate(size)
+
+
+def s3_inputs(**kwargs):
+    inputs = dict(CREDENTIALS, bucket_name=BUCKET, create_bucket=False, make_public=False, presigned_url_expiry=0,
+                  content_type='binary/octet-stream', is_directory=True)
+    inputs.update(kwargs)
+    return inputs
+
+
+def save_small_files(aws, workdir, args):
+    count = int(10000 * args.scale)
+    write_files(os.path.join(workdir, 'small'), count, 4 * 1024)
+    return 'aws_save_to_s3', s3_inputs(source_path=os.path.join(workdir, 'small'), target_path='small', create_bucket=True), count, count * 4 * 1024
+
+
+def get_small_files(aws, workdir, args):
+    count = int(10000 * args.scale)
+    for i in range(count):
+        aws.put_object(BUCKET, 'small/file-%06d.dat' % i, 4 * 1024, data=os.urandom(4 * 1024))
+    return 'aws_get_from_s3', s3_inputs(source_path='small', target_path=os.path.join(workdir, 'download')), count, count * 4 * 1024
+
+
+def get_manifest_files(aws, workdir, args):
+    count = int(10000 * args.scale)
+    objects = []
+    for i in range(count):
+        key = 'small/file-%06d.dat' % i
+        aws.put_object(BUCKET, key, 4 * 1024, data=os.urandom(4 * 1024))
+        objects.append({'key': key, 'size': 4 * 1024, 'etag': aws.buckets[BUCKET][key]['etag'], 'content_type': 'binary/octet-stream'})
+    write_manifest(aws.get_client('s3'), BUCKET, 'small', objects)
+    aws.requests = {}
+    return 'aws_get_from_s3', s3_inputs(source_path='small', target_path=os.path.join(workdir, 'download'), use_manifest=True), count, count * 4 * 1024
+
+
+def save_large_files(aws, workdir, args):
+    count, size = 3, int(2 * GB * args.scale)
+    write_files(os.path.join(workdir, 'large'), count, size)
+    return 'aws_save_to_s3', s3_inputs(source_path=os.path.join(workdir, 'large'), target_path='large', create_bucket=True), count, count * size
+
+
+def get_large_files(aws, workdir, args):
+    count, size = 3, int(2 * GB * args.scale)
+    for i in range(count):
+        aws.put_object(BUCKET, 'large/file-%06d.dat' % i, size)
+    return 'aws_get_from_s3', s3_inputs(source_path='large', target_path=os.path.join(workdir, 'download')), count, count * size
+
+
+def verified(scenario):
+    def verified_scenario(aws, workdir, args):
+        service_name, inputs, items, size = scenario(aws, workdir, args)
+        return service_name, dict(inputs, verify_checksums=True), items, size
+    return verified_scenario
+
+
+def copy_files(aws, workdir, args):
+    count, size = int(10000 * args.scale), int(2 * GB * args.scale)
+    for i in range(count):
+        aws.put_object(BUCKET, 'builds/small/file-%06d.dat' % i, 4 * 1024, data=os.urandom(4 * 1024))
+    for i in range(3):
+        aws.put_object(BUCKET, 'builds/large/file-%06d.dat' % i, size)
+    inputs = dict(CREDENTIALS, source_bucket=BUCKET, source_path='builds', target_bucket=BUCKET + '-target', target_path='release',
+                  is_directory=True)
+    return 'aws_copy_in_s3', inputs, count + 3, count * 4 * 1024 + 3 * size
+
+
+def stack_template(instances):
+    resources = {}
+    for i in range(instances):
+        resources['Instance%03d' % i] = {
+            'Type': 'AWS::EC2::Instance',
+            'Properties': {
+                'ImageId': 'ami-00000000',
+                'InstanceType': 't2.micro',
+                'Tags': [{'Key': 'OperetoAgentOs', 'Value': 'linux'}]
+            }
+        }
+    return {'AWSTemplateFormatVersion': '2010-09-09', 'Resources': resources}
+
+
+def create_stack(aws, workdir, args):
+    instances = int(100 * args.scale)
+    inputs = dict(CREDENTIALS, aws_region='us-east-1', cf_stack_name='benchmark-stack', cf_template=stack_template(instances),
+                  cf_template_url=None, cf_template_bucket=BUCKET, cf_capabilities='', cf_globals=None, cf_parameters={},
+                  cf_tags={}, install_core_tools=True, install_container_tools=False, opereto_host='https://opereto.local',
+                  opereto_token='benchmark', agent_package_url={'linux': 'https://opereto.local/agent.tar.gz', 'windows': 'https://opereto.local/agent.zip'},
+                  connectivity_ports=args.connectivity_port, connectivity_attempts=1)
+    aws.buckets.setdefault(BUCKET, {})
+    return 'aws_create_cf_stack', inputs, instances, 0
+
+
+def remove_stacks(aws, workdir, args):
+    count = int(50 * args.scale)
+    cf_client = aws.get_client('cloudformation', region='us-east-1')
+    for i in range(count):
+        cf_client.create_stack(StackName='benchmark-remove-%03d' % i, TemplateBody=json.dumps(stack_template(2)))
+    aws.requests = {}
+    return 'aws_remove_cf_stack', dict(CREDENTIALS, aws_region='us-east-1', cf_stack_name=None, cf_stack_prefix='benchmark-remove-'), count, 0
+
+
+SCENARIOS = [
+    ('save_small_files', save_small_files),
+    ('get_small_files', get_small_files),
+    ('get_manifest_files', get_manifest_files),
+    ('save_large_files', save_large_files),
+    ('get_large_files', get_large_files),
+    ('save_verified', verified(save_large_files)),
+    ('get_verified', verified(get_large_files)),
+    ('copy_files', copy_files),
+    ('create_stack', create_stack),
+    ('remove_stacks', remove_stacks)
+]
+
+
+def run_scenario(name, scenario, args):
+    aws = FakeAWS(latency=args.latency / 1000.0, throttle_rate=args.throttle_rate, stack_time=args.stack_time,
+                  delete_time=args.stack_time / 2.0, boot_time=args.boot_time)
+    opereto_client = FakeOperetoClient(aws, latency=args.opereto_latency / 1000.0)
+    workdir = tempfile.mkdtemp(prefix='opereto-benchmark-')
+    listener = socket.socket()
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(128)
+        ## instances are reachable on a local port, so that connectivity probes succeed
+        args.connectivity_port = listener.getsockname()[1]
+        service_name, inputs, items, size = scenario(aws, workdir, args)
+        inputs['metrics_file'] = os.path.join(workdir, 'metrics.jsonl')
+        print '== %s (%s)' % (name, service_name)
+        result, seconds = run_service(service_name, inputs, aws, opereto_client)
+    finally:
+        listener.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    metrics = opereto_client.properties.get('service_metrics') or {}
+    counters = metrics.get('counters', {})
+    return {
+        'scenario': name,
+        'service': service_name,
+        'result': result,
+        'seconds': round(seconds, 3),
+        'items': items,
+        'items_per_second': round(items / seconds, 1) if seconds else None,
+        'mb_per_second': round(size / float(MB) / seconds, 1) if size and seconds else None,
+        'api_calls': counters.get('api_calls', 0),
+        'http_requests': aws.total_requests(),
+        'retries': counters.get('retries', 0),
+        'throttles': aws.throttles,
+        'requests': aws.requests,
+        'opereto_calls': opereto_client.calls,
+        'phases': metrics.get('phases', [])
+    }
+
+
+def print_report(results):
+    print
+    print '%-18s %-8s %9s %10s %9s %10s %8s %9s' % ('scenario', 'result', 'seconds', 'items/s', 'MB/s', 'api calls', 'retries', 'throttles')
+    for r in results:
+        print '%-18s %-8s %9.1f %10s %9s %10d %8d %9d' % (r['scenario'], r['result'], r['seconds'], r['items_per_second'] or '-',
+                                                        r['mb_per_second'] or '-', r['api_calls'], r['retries'], r['throttles'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the AWS services against local AWS stand-ins.')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run (default: all): %s' % ', '.join([name for name, scenario in SCENARIOS]))
+    parser.add_argument('--latency', type=float, default=20, help='latency of each AWS request in milliseconds')
+    parser.add_argument('--opereto-latency', type=float, default=10, help='latency of each opereto server call in milliseconds')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of AWS requests that are throttled')
+    parser.add_argument('--stack-time', type=float, default=20, help='seconds until a stack is created')
+    parser.add_argument('--boot-time', type=float, default=10, help='seconds until stack instances are running')
+    parser.add_argument('--scale', type=float, default=1.0, help='scales the number of files, file sizes, instances and stacks')
+    parser.add_argument('--json', help='a file to write the results to')
+    args = parser.parse_args()
+
+    selected = args.scenarios or [name for name, scenario in SCENARIOS]
+    unknown = set(selected) - set([name for name, scenario in SCENARIOS])
+    if unknown:
+        parser.error('unknown scenarios: %s' % ', '.join(sorted(unknown)))
+
+    results = [run_scenario(name, scenario, args) for name, scenario in SCENARIOS if name in selected]
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+    return 0 if all([r['result'] == FakeOperetoClient.SUCCESS for r in results]) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
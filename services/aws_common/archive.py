@@ -0,0 +1,77 @@
+import os
+import tarfile
+from opereto.exceptions import OperetoRuntimeError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_FORMATS = {
+    'tar.gz': 'application/gzip',
+    'tar.zst': 'application/zstd'
+}
+
+
+def archive_format_of(key):
+    if key.endswith('.tar.gz') or key.endswith('.tgz'):
+        return 'tar.gz'
+    if key.endswith('.tar.zst'):
+        return 'tar.zst'
+    raise OperetoRuntimeError('Unknown archive format of {}, supported extensions are .tar.gz, .tgz and .tar.zst'.format(key))
+
+
+def _zstandard():
+    if zstandard is None:
+        raise OperetoRuntimeError('tar.zst archives require the zstandard python package')
+    return zstandard
+
+
+def write_archive(source_path, arcname, fileobj, archive_format):
+    ## streams the directory tree into fileobj, only a single compression buffer is held in memory
+    if archive_format == 'tar.zst':
+        compressor = _zstandard().ZstdCompressor().stream_writer(fileobj)
+        tar = tarfile.open(fileobj=compressor, mode='w|')
+    else:
+        compressor = None
+        tar = tarfile.open(fileobj=fileobj, mode='w|gz')
+    files = 0
+    for root, dirs, names in os.walk(source_path):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            tar.add(path, arcname=os.path.join(arcname, os.path.relpath(path, source_path)), recursive=False)
+            files += 1
+    tar.close()
+    if compressor:
+        compressor.flush(zstandard.FLUSH_FRAME)
+    return files
+
+
+def extract_archive(fileobj, target_path, archive_format):
+    ## extracts the archive while it is read from fileobj, members escaping the target directory are refused
+    if archive_format == 'tar.zst':
+        tar = tarfile.open(fileobj=_zstandard().ZstdDecompressor().stream_reader(fileobj), mode='r|')
+    else:
+        tar = tarfile.open(fileobj=fileobj, mode='r|gz')
+    target_root = os.path.realpath(target_path)
+
+    def is_inside(path):
+        path = os.path.realpath(path)
+        return path == target_root or path.startswith(target_root + os.sep)
+
+    files = 0
+    for member in tar:
+        member_path = os.path.join(target_root, member.name)
+        escapes = not is_inside(member_path)
+        if member.issym():
+            escapes = escapes or not is_inside(os.path.join(os.path.dirname(member_path), member.linkname))
+        elif member.islnk():
+            escapes = escapes or not is_inside(os.path.join(target_root, member.linkname))
+        if escapes:
+            raise OperetoRuntimeError('Refusing to extract archive member {} outside of {}'.format(member.name, target_path))
+        tar.extract(member, target_root)
+        if member.isfile():
+            files += 1
+    tar.close()
+    return files
@@ -0,0 +1,169 @@
+import base64
+import hashlib
+import sys
+import threading
+from botocore.exceptions import ClientError
+from opereto.exceptions import OperetoRuntimeError
+from aws_common.clients import error_code
+from aws_common.transfer import etag_part_sizes
+
+CHECKSUM_ALGORITHM = 'md5'
+
+
+class ChecksumMismatch(OperetoRuntimeError):
+    pass
+
+
+def multipart_etag(digests):
+    return '%s-%d' % (hashlib.md5(''.join(digests)).hexdigest(), len(digests))
+
+
+def has_md5_etag(response):
+    ## etags of objects encrypted with SSE-KMS or SSE-C keys are not based on the md5 of their content
+    return response.get('ServerSideEncryption') != 'aws:kms' and not response.get('SSECustomerAlgorithm')
+
+
+def send_verified(send, key, data, checksums, **kwargs):
+    """
+    Sends a put_object or upload_part request with the Content-MD5 of its body, so that s3 rejects a body corrupted
+    on its way, and checks the returned etag when it is md5 based. Mismatches are recorded in the checksum summary.
+    """
+    digest = hashlib.md5(data).digest()
+    try:
+        response = send(Body=data, ContentMD5=base64.b64encode(digest), **kwargs)
+    except ClientError, e:
+        if error_code(e) == 'BadDigest':
+            checksums.add_mismatched(key)
+            raise ChecksumMismatch('The content of {} was corrupted on its way to s3: {}'.format(key, str(e)))
+        raise
+    if has_md5_etag(response) and response['ETag'].strip('"') != digest.encode('hex'):
+        checksums.add_mismatched(key)
+        raise ChecksumMismatch('The etag of {} returned by s3 does not match the md5 of the sent data'.format(key))
+    return response
+
+
+class EtagHasher(object):
+    """
+    Computes the etag s3 would assign to data passed in order, for each candidate part size of a multipart etag,
+    so that transferred data is verified while it is written rather than by reading it again.
+    """
+
+    def __init__(self, size, etag, settings=None):
+        self.etag = etag.strip('"')
+        self.multipart = '-' in self.etag
+        self.part_sizes = etag_part_sizes(size, self.etag, settings)
+        self.digests = [[] for part_size in self.part_sizes]
+        self.hashes = [hashlib.md5() for part_size in self.part_sizes]
+        self.hashed = [0 for part_size in self.part_sizes]
+
+    def update(self, data):
+        for i, part_size in enumerate(self.part_sizes):
+            offset = 0
+            while offset < len(data):
+                length = min(part_size - self.hashed[i], len(data) - offset)
+                self.hashes[i].update(buffer(data, offset, length))
+                self.hashed[i] += length
+                offset += length
+                if self.hashed[i] == part_size:
+                    self.digests[i].append(self.hashes[i].digest())
+                    self.hashes[i] = hashlib.md5()
+                    self.hashed[i] = 0
+
+    def etags(self):
+        etags = []
+        for i in range(len(self.part_sizes)):
+            digests = self.digests[i]
+            if self.hashed[i] or not digests:
+                digests = digests + [self.hashes[i].digest()]
+            etags.append(multipart_etag(digests) if self.multipart else digests[0].encode('hex'))
+        return etags
+
+    def matches(self):
+        return self.etag in self.etags()
+
+
+class HashingWriter(object):
+    """
+    A write only file-like object passing the written data through an EtagHasher to the target file object.
+    """
+
+    def __init__(self, fileobj, hasher):
+        self.fileobj = fileobj
+        self.hasher = hasher
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+class HashingReader(object):
+    """
+    A read only file-like object passing the data read from the source file object through an EtagHasher.
+    """
+
+    def __init__(self, fileobj, hasher):
+        self.fileobj = fileobj
+        self.hasher = hasher
+
+    def read(self, size=-1):
+        data = self.fileobj.read() if size is None or size < 0 else self.fileobj.read(size)
+        self.hasher.update(data)
+        return data
+
+
+class ChecksumSummary(object):
+    """
+    Thread safe counts of the objects verified against the checksums stored by s3, the objects that could not be
+    verified (e.g. objects encrypted with SSE-KMS keys) and the keys whose content did not match.
+    """
+
+    def __init__(self):
+        self.verified = 0
+        self.unverified = 0
+        self.mismatched = []
+        self.lock = threading.Lock()
+
+    def add_verified(self):
+        with self.lock:
+            self.verified += 1
+
+    def add_unverified(self):
+        with self.lock:
+            self.unverified += 1
+
+    def add_mismatched(self, key):
+        with self.lock:
+            self.mismatched.append(key)
+
+    def check(self, key, hasher, head):
+        """
+        Records the verification of downloaded data, raises ChecksumMismatch if it does not match the object etag.
+        """
+        if not has_md5_etag(head) or not hasher.part_sizes:
+            self.add_unverified()
+            return
+        if not hasher.matches():
+            self.add_mismatched(key)
+            raise ChecksumMismatch('The content of {} does not match its etag {}'.format(key, hasher.etag))
+        self.add_verified()
+
+    def summary(self):
+        with self.lock:
+            return {
+                'algorithm': CHECKSUM_ALGORITHM,
+                'verified': self.verified,
+                'unverified': self.unverified,
+                'mismatched': sorted(self.mismatched)
+            }
+
+    def publish(self, client):
+        ## like the service metrics, failing to publish the summary does not fail the service
+        try:
+            summary = self.summary()
+            print 'Checksum summary: {} verified, {} unverified, {} mismatched.'.format(summary['verified'], summary['unverified'], len(summary['mismatched']))
+            client.modify_process_property('checksum_summary', summary)
+        except Exception, e:
+            print >> sys.stderr, 'Failed to publish the checksum summary: %s' % str(e)
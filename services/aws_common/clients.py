@@ -0,0 +1,64 @@
+import threading
+import boto3
+import botocore.config
+from botocore.exceptions import ClientError
+
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+RETRY_MAX_ATTEMPTS = 10
+RETRY_MODE = 'adaptive'
+THROTTLING_ERRORS = ['Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'SlowDown']
+
+_lock = threading.Lock()
+_sessions = {}
+_clients = {}
+
+
+def _client_config(region, max_pool_connections):
+    kwargs = {
+        'region_name': region,
+        'max_pool_connections': max_pool_connections,
+        'retries': {'max_attempts': RETRY_MAX_ATTEMPTS, 'mode': RETRY_MODE}
+    }
+    ## older botocore releases do not support tcp keep-alive, connections are still reused through the client pool
+    try:
+        return botocore.config.Config(tcp_keepalive=True, **kwargs)
+    except TypeError:
+        return botocore.config.Config(**kwargs)
+
+
+def get_session(aws_access_key, aws_secret_key, region=None):
+    """
+    Returns a boto3 session shared by all callers with the same credentials and region.
+    """
+    key = (aws_access_key, aws_secret_key, region)
+    with _lock:
+        if key not in _sessions:
+            _sessions[key] = boto3.session.Session(aws_access_key_id=aws_access_key, aws_secret_access_key=aws_secret_key,
+                                                   region_name=region)
+        return _sessions[key]
+
+
+def get_client(service_name, aws_access_key, aws_secret_key, region=None, max_pool_connections=None):
+    """
+    Returns a boto3 client shared by all callers with the same credentials, region and connection pool size.
+    Clients use adaptive retries (client side rate limiting on throttling) and keep their connections alive,
+    so the connection pool should be at least as large as the number of threads using the client.
+    """
+    max_pool_connections = max(max_pool_connections or 0, DEFAULT_MAX_POOL_CONNECTIONS)
+    key = (service_name, aws_access_key, aws_secret_key, region, max_pool_connections)
+    session = get_session(aws_access_key, aws_secret_key, region)
+    ## sessions are not thread safe, clients are created under the lock and may then be shared by threads
+    with _lock:
+        if key not in _clients:
+            _clients[key] = session.client(service_name, config=_client_config(region, max_pool_connections))
+        return _clients[key]
+
+
+def error_code(e):
+    if isinstance(e, ClientError):
+        return e.response.get('Error', {}).get('Code')
+    return None
+
+
+def is_throttling_error(e):
+    return error_code(e) in THROTTLING_ERRORS
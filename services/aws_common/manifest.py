@@ -0,0 +1,61 @@
+import json
+import time
+from botocore.exceptions import ClientError
+from aws_common.clients import error_code
+
+MANIFEST_NAME = '.s3_manifest.json'
+MANIFEST_VERSION = 1
+MISSING_OBJECT_ERRORS = ['NoSuchKey', '404']
+
+
+def manifest_key(prefix):
+    prefix = prefix.rstrip('/')
+    return '%s/%s' % (prefix, MANIFEST_NAME) if prefix else MANIFEST_NAME
+
+
+def write_manifest(client, bucket, prefix, objects, extra_args=None, url_expiry=0):
+    """
+    Stores the manifest of a saved directory next to its objects, under <prefix>/.s3_manifest.json. Objects are
+    dicts of key, size, etag and content_type. Keys are stored relative to the prefix, so the manifest stays valid when
+    the prefix is copied or moved. If url_expiry is set, a pre-signed url is generated for each object (signing is
+    local, no request is sent). Returns the manifest key.
+    """
+    prefix = prefix.rstrip('/')
+    entries = []
+    for obj in sorted(objects, key=lambda obj: obj['key']):
+        entry = {
+            'key': obj['key'][len(prefix):].lstrip('/'),
+            'size': obj['size'],
+            'etag': obj['etag'],
+            'content_type': obj['content_type']
+        }
+        if url_expiry:
+            entry['url'] = client.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': obj['key']}, ExpiresIn=url_expiry)
+        entries.append(entry)
+    manifest = {'version': MANIFEST_VERSION, 'created': int(time.time()), 'objects': entries}
+    if url_expiry:
+        manifest['url_expiry'] = url_expiry
+
+    key = manifest_key(prefix)
+    put_args = dict(extra_args or {}, ContentType='application/json')
+    client.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest, separators=(',', ':')), **put_args)
+    return key
+
+
+def read_manifest(client, bucket, prefix):
+    """
+    Returns the objects listed in the manifest stored under prefix, as (key, size, etag) with keys resolved against
+    the given prefix, or None if the prefix has no manifest.
+    """
+    prefix = prefix.rstrip('/')
+    try:
+        response = client.get_object(Bucket=bucket, Key=manifest_key(prefix))
+    except ClientError, e:
+        if error_code(e) in MISSING_OBJECT_ERRORS:
+            return None
+        raise
+    manifest = json.loads(response['Body'].read())
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError('Unsupported manifest version: %s' % manifest.get('version'))
+    return [('%s/%s' % (prefix, entry['key']) if prefix else entry['key'], entry['size'], entry['etag'])
+            for entry in manifest['objects']]
@@ -0,0 +1,118 @@
+import json
+import os
+import sys
+import threading
+import time
+from aws_common.clients import THROTTLING_ERRORS
+
+METRICS_DIR = os.path.join(os.path.expanduser('~'), '.opereto', 'metrics')
+
+
+class ServiceMetrics(object):
+    """
+    Collects the duration of each service phase and thread safe counters (AWS API calls, retries, throttles,
+    transferred files and bytes). Phases are started by the service step titles, each phase ends when the next
+    one starts. Counters are also recorded per phase.
+    """
+
+    def __init__(self, service_name):
+        self.service_name = service_name
+        self.started = time.time()
+        self.phases = []
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.instrumented_clients = set()
+        self._start_phase('setup')
+
+    def _start_phase(self, name):
+        now = time.time()
+        if self.phases:
+            self.phases[-1]['seconds'] = round(now - self.phases[-1]['started'], 3)
+        self.phases.append({'name': name, 'started': now, 'seconds': None, 'counters': {}})
+
+    def phase(self, name):
+        with self.lock:
+            self._start_phase(name)
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            phase_counters = self.phases[-1]['counters']
+            phase_counters[name] = phase_counters.get(name, 0) + value
+
+    def instrument(self, client):
+        """
+        Counts the API calls, HTTP attempts (retries) and throttling responses of a boto3 client.
+        Returns the client so that it can wrap client creation.
+        """
+        with self.lock:
+            if id(client) in self.instrumented_clients:
+                return client
+            self.instrumented_clients.add(id(client))
+        service = client.meta.service_model.service_name
+
+        def before_call(model, **kwargs):
+            self.incr('api_calls')
+            self.incr('api_calls.%s.%s' % (service, model.name))
+
+        def needs_retry(response, attempts, **kwargs):
+            if response and response[1].get('Error', {}).get('Code') in THROTTLING_ERRORS:
+                self.incr('throttles')
+
+        def before_send(**kwargs):
+            self.incr('http_requests')
+
+        client.meta.events.register('before-call', before_call)
+        client.meta.events.register('needs-retry', needs_retry)
+        client.meta.events.register('before-send', before_send)
+        return client
+
+    def summary(self):
+        with self.lock:
+            now = time.time()
+            counters = dict(self.counters)
+            ## every http request beyond the first one of an api call is a retry
+            counters['retries'] = max(0, counters.get('http_requests', 0) - counters.get('api_calls', 0))
+            return {
+                'service': self.service_name,
+                'total_seconds': round(now - self.started, 3),
+                'phases': [{'name': phase['name'],
+                            'seconds': phase['seconds'] if phase['seconds'] is not None else round(now - phase['started'], 3),
+                            'counters': dict(phase['counters'])} for phase in self.phases],
+                'counters': counters
+            }
+
+    def write(self, path=None, **fields):
+        """
+        Writes the summary to a json lines file: a line per phase followed by a line with the totals. The file is
+        overwritten, by default each run has its own file under METRICS_DIR, named by the service and process id.
+        """
+        summary = self.summary()
+        if not path:
+            path = os.path.join(METRICS_DIR, '%s-%s.jsonl' % (self.service_name, fields.get('pid') or os.getpid()))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            for phase in summary['phases']:
+                record = dict(fields, service=self.service_name, type='phase', timestamp=self.started)
+                record.update(phase)
+                f.write(json.dumps(record) + '\n')
+            record = dict(fields, service=self.service_name, type='total', timestamp=self.started,
+                          seconds=summary['total_seconds'], counters=summary['counters'])
+            f.write(json.dumps(record) + '\n')
+        return summary
+
+    def publish(self, client, path=None, **fields):
+        """
+        Prints the timing summary, writes it to the metrics file and sets it as the service_metrics process property.
+        Metrics are best effort, failing to publish them does not fail the service.
+        """
+        try:
+            summary = self.write(path, **fields)
+            print 'Service timing summary:'
+            for phase in summary['phases']:
+                print '%8.1fs  %s' % (phase['seconds'], phase['name'])
+            print '%8.1fs  total (%s)' % (summary['total_seconds'], ', '.join(['%s: %s' % (k, v) for k, v in sorted(summary['counters'].items()) if '.' not in k]))
+            client.modify_process_property('service_metrics', summary)
+        except Exception, e:
+            print >> sys.stderr, 'Failed to publish service metrics: %s' % str(e)
@@ -0,0 +1,65 @@
+import errno
+import os
+import select
+import socket
+import time
+
+MAX_SOCKETS_PER_ROUND = 500
+CONNECT_IN_PROGRESS = [errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY]
+
+
+def _probe_once(targets, timeout):
+    ## starts non-blocking connects to all targets and waits for them together, returns the failed targets errors
+    errors = {}
+    sockets = {}
+    for target in targets:
+        host, port = target
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setblocking(0)
+        err = s.connect_ex((host, port))
+        if err in CONNECT_IN_PROGRESS:
+            sockets[s] = target
+            continue
+        if err:
+            errors[target] = os.strerror(err)
+        s.close()
+
+    deadline = time.time() + timeout
+    while sockets:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        _, writable, _ = select.select([], sockets.keys(), [], remaining)
+        for s in writable:
+            target = sockets.pop(s)
+            err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                errors[target] = os.strerror(err)
+            s.close()
+
+    for s, target in sockets.items():
+        errors[target] = 'connection timed out after %s seconds' % timeout
+        s.close()
+    return errors
+
+
+def probe_ports(targets, timeout=5, attempts=3, retry_interval=2):
+    """
+    Checks that TCP connections can be opened to all (host, port) targets. All targets are probed in parallel and
+    only the failed ones are retried, so the total time is bounded by the slowest target.
+    Returns a map of (host, port) to None if reachable or to the last connect error.
+    """
+    results = {}
+    remaining = sorted(set(targets))
+    for attempt in range(attempts):
+        errors = {}
+        for i in range(0, len(remaining), MAX_SOCKETS_PER_ROUND):
+            errors.update(_probe_once(remaining[i:i+MAX_SOCKETS_PER_ROUND], timeout))
+        for target in remaining:
+            results[target] = errors.get(target)
+        remaining = sorted(errors.keys())
+        if not remaining:
+            break
+        if attempt < attempts - 1:
+            time.sleep(retry_interval)
+    return results
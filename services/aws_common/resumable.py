@@ -0,0 +1,118 @@
+import json
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+from opereto.exceptions import OperetoRuntimeError
+from aws_common.transfer import compute_etag, etag_part_sizes
+from aws_common.checksums import has_md5_etag
+
+READ_BUFFER_SIZE = 1024 * 1024
+RANGE_ATTEMPTS = 3
+
+
+class ResumableDownload(object):
+    """
+    Downloads an s3 object with parallel ranged GETs into a <local_path>.part file. Completed ranges are recorded
+    in a <local_path>.part.json state file, so a retried download only fetches the missing ranges. The file is
+    renamed into place once all ranges are fetched and its etag is verified. Objects whose etag is not md5 based
+    (SSE-KMS or SSE-C encryption) or whose part size cannot be derived from it are not verified (see verified).
+    """
+
+    def __init__(self, client, bucket, key, local_path, settings):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.local_path = local_path
+        self.settings = settings
+        self.part_path = local_path + '.part'
+        self.state_path = self.part_path + '.json'
+        self.lock = threading.Lock()
+        self.verified = False
+
+    def _load_state(self, size, etag, chunksize):
+        if os.path.isfile(self.state_path) and os.path.isfile(self.part_path):
+            try:
+                with open(self.state_path) as f:
+                    state = json.load(f)
+                if state['etag'] == etag and state['size'] == size and state['chunksize'] == chunksize:
+                    return state
+            except (ValueError, KeyError):
+                pass
+        with open(self.part_path, 'wb') as f:
+            f.truncate(size)
+        return {'etag': etag, 'size': size, 'chunksize': chunksize, 'done': []}
+
+    def _save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.rename(tmp_path, self.state_path)
+
+    def _fetch_range(self, index):
+        chunksize = self.state['chunksize']
+        start = index * chunksize
+        end = min(start + chunksize, self.state['size']) - 1
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key, Range='bytes=%d-%d' % (start, end), IfMatch='"%s"' % self.state['etag'])
+            with open(self.part_path, 'r+b') as f:
+                f.seek(start)
+                body = response['Body']
+                while True:
+                    data = body.read(READ_BUFFER_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+        except Exception, e:
+            return index, str(e)
+        with self.lock:
+            self.state['done'].append(index)
+            self._save_state()
+        return index, None
+
+    def _verify(self, part_sizes):
+        etag = self.state['etag']
+        for part_size in part_sizes:
+            if compute_etag(self.part_path, part_size) == etag:
+                return True
+        return False
+
+    def download(self):
+        head = self.client.head_object(Bucket=self.bucket, Key=self.key)
+        size = head['ContentLength']
+        etag = head['ETag'].strip('"')
+        chunksize = self.settings.chunksize(size)
+        self.state = self._load_state(size, etag, chunksize)
+
+        ranges = -(-size // chunksize)
+        if self.state['done']:
+            print 'Resuming download of {} ({} of {} ranges already fetched)..'.format(self.key, len(self.state['done']), ranges)
+
+        errors = {}
+        for attempt in range(RANGE_ATTEMPTS):
+            missing = sorted(set(range(ranges)) - set(self.state['done']))
+            if not missing:
+                break
+            errors = {}
+            pool = ThreadPool(min(self.settings.concurrency(size), len(missing)))
+            try:
+                for index, error in pool.imap_unordered(self._fetch_range, missing):
+                    if error:
+                        errors[index] = error
+            finally:
+                pool.close()
+                pool.join()
+
+        if errors:
+            raise OperetoRuntimeError('Failed to fetch {} ranges of {}, rerun to resume the download: {}'.format(len(errors), self.key, errors.values()[0]))
+
+        ## a file that cannot be verified is kept as is, failing it would make every rerun fetch it again
+        part_sizes = etag_part_sizes(size, etag, self.settings) if has_md5_etag(head) else []
+        if not part_sizes:
+            print 'The etag of {} is not md5 based or its part size is unknown, the downloaded file is not verified.'.format(self.key)
+        elif not self._verify(part_sizes):
+            os.remove(self.state_path)
+            raise OperetoRuntimeError('Downloaded file {} does not match the etag of {}'.format(self.part_path, self.key))
+        self.verified = bool(part_sizes)
+
+        os.rename(self.part_path, self.local_path)
+        os.remove(self.state_path)
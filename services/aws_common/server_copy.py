@@ -0,0 +1,51 @@
+from multiprocessing.pool import ThreadPool
+from aws_common.transfer import MB, GB
+
+MAX_COPY_OBJECT_SIZE = 5 * GB
+DEFAULT_COPY_THRESHOLD = 256 * MB
+## CopyObject keeps the object headers, a multipart copy must set them on the new upload
+COPIED_HEADERS = ['ContentType', 'ContentEncoding', 'ContentDisposition', 'ContentLanguage', 'CacheControl', 'Expires', 'Metadata']
+
+
+def copy_threshold(settings):
+    return min(settings.multipart_threshold or DEFAULT_COPY_THRESHOLD, MAX_COPY_OBJECT_SIZE)
+
+
+def copy_object(client, source_bucket, source_key, bucket, key, size, etag, settings, extra_args=None, source_client=None):
+    """
+    Copies an object server side, its data does not pass through the agent. Objects below the copy threshold are
+    copied with a single CopyObject call, larger ones (and any object over the 5GB CopyObject limit) as a multipart
+    upload of parallel UploadPartCopy ranges, pinned to the source etag. The client must belong to the target bucket
+    region, source_client (if given) to the source bucket region.
+    """
+    extra_args = extra_args or {}
+    copy_source = {'Bucket': source_bucket, 'Key': source_key}
+    if size < copy_threshold(settings):
+        client.copy_object(Bucket=bucket, Key=key, CopySource=copy_source, CopySourceIfMatch=etag, **extra_args)
+        return
+
+    head = (source_client or client).head_object(Bucket=source_bucket, Key=source_key, IfMatch=etag)
+    upload_args = dict([(header, head[header]) for header in COPIED_HEADERS if head.get(header)])
+    upload_args.update(extra_args)
+    upload_id = client.create_multipart_upload(Bucket=bucket, Key=key, **upload_args)['UploadId']
+
+    chunksize = settings.chunksize(size)
+    ranges = [(start, min(start + chunksize, size) - 1) for start in range(0, size, chunksize)]
+
+    def copy_part(part):
+        part_number, byte_range = part
+        response = client.upload_part_copy(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, CopySource=copy_source,
+                                           CopySourceRange='bytes=%d-%d' % byte_range, CopySourceIfMatch=etag)
+        return {'PartNumber': part_number, 'ETag': response['CopyPartResult']['ETag']}
+
+    ## any failure, including of the completion, aborts the upload so that its copied parts are not left behind
+    pool = ThreadPool(min(settings.concurrency(size), len(ranges)))
+    try:
+        parts = pool.map(copy_part, list(enumerate(ranges, 1)))
+        client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+    except:
+        client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,194 @@
+import random
+import time
+from botocore.exceptions import ClientError
+from aws_common.clients import is_throttling_error
+from opereto.exceptions import OperetoRuntimeError
+
+MIN_POLL_INTERVAL = 5
+MAX_POLL_INTERVAL = 30
+BACKOFF_FACTOR = 1.5
+
+CREATE_SUCCESS_STATES = ['CREATE_COMPLETE']
+CREATE_FAILURE_STATES = ['CREATE_FAILED', 'ROLLBACK_IN_PROGRESS', 'ROLLBACK_FAILED', 'ROLLBACK_COMPLETE']
+UPDATE_SUCCESS_STATES = ['UPDATE_COMPLETE', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS']
+UPDATE_FAILURE_STATES = ['UPDATE_FAILED', 'UPDATE_ROLLBACK_IN_PROGRESS', 'UPDATE_ROLLBACK_FAILED', 'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_ROLLBACK_COMPLETE']
+DELETE_SUCCESS_STATES = ['DELETE_COMPLETE']
+DELETE_FAILURE_STATES = ['DELETE_FAILED']
+
+
+class StackWaiter(object):
+    """
+    Waits for a cloud formation stack to reach a terminal state with a single describe_stacks call per tick.
+    New stack events are tailed by event id and printed as they occur. The poll interval starts short, backs off
+    exponentially (with jitter) while nothing changes and is reset on any progress.
+    """
+
+    def __init__(self, cf_client, stack_id, min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL):
+        self.cf_client = cf_client
+        self.stack_id = stack_id
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.events = []
+        self.seen_event_ids = set()
+        self.api_calls = 0
+
+    def skip_existing_events(self):
+        """
+        Marks the events that occurred so far as seen, so that only the events of the coming operation are tailed and
+        recorded. Must be called before the operation starts. Since new events are tailed until a known one is reached,
+        the newest page is enough.
+        """
+        self.api_calls += 1
+        for event in self.cf_client.describe_stack_events(StackName=self.stack_id)['StackEvents']:
+            self.seen_event_ids.add(event['EventId'])
+
+    def _new_events(self):
+        ## events are returned newest first, pages are fetched until a known event is reached
+        new_events = []
+        next_token = None
+        while True:
+            self.api_calls += 1
+            params = {'StackName': self.stack_id}
+            if next_token:
+                params['NextToken'] = next_token
+            page = self.cf_client.describe_stack_events(**params)
+            for event in page['StackEvents']:
+                if event['EventId'] in self.seen_event_ids:
+                    next_token = None
+                    break
+                new_events.append(event)
+            else:
+                next_token = page.get('NextToken')
+            if not next_token:
+                break
+        new_events.reverse()
+        for event in new_events:
+            self.seen_event_ids.add(event['EventId'])
+            self.events.append(event)
+        return new_events
+
+    def _backoff(self, progress):
+        if progress:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * BACKOFF_FACTOR, self.max_interval)
+        time.sleep(self.interval * random.uniform(0.8, 1.2))
+
+    def wait(self, success_states, failure_states, timeout=None):
+        """
+        Returns the stack description once its status is one of success_states or failure_states.
+        """
+        deadline = time.time() + timeout if timeout else None
+        last_status = None
+        while True:
+            try:
+                self.api_calls += 1
+                stack = self.cf_client.describe_stacks(StackName=self.stack_id)['Stacks'][0]
+                new_events = self._new_events()
+            except ClientError, e:
+                if not is_throttling_error(e):
+                    raise
+                print 'AWS API throttled, slowing down..'
+                self.interval = self.max_interval
+                time.sleep(self.interval * random.uniform(0.8, 1.2))
+                continue
+
+            for event in new_events:
+                print '%s %s [%s] %s' % (event['Timestamp'], event['LogicalResourceId'], event['ResourceStatus'], event.get('ResourceStatusReason') or '')
+
+            status = stack['StackStatus']
+            if status in success_states or status in failure_states:
+                return stack
+            if deadline and time.time() > deadline:
+                raise OperetoRuntimeError('Timed out waiting for stack %s (status is %s)' % (self.stack_id, status))
+            self._backoff(bool(new_events) or status != last_status)
+            last_status = status
+
+
+class MultiStackWaiter(object):
+    """
+    Waits for many stacks, possibly in several regions, to reach a terminal state. Each tick issues a single paged
+    list_stacks poll per region covering all of its pending stacks. Every region has its own poll interval, backing
+    off while nothing changes and on throttling, so that the API rate limit of one region does not slow down the others.
+    """
+
+    def __init__(self, min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.regions = {}
+        self.stacks = {}
+        self.api_calls = 0
+
+    def add(self, region, cf_client, stack_id, stack_name, success_states, failure_states):
+        if region not in self.regions:
+            self.regions[region] = {'client': cf_client, 'interval': self.min_interval, 'next_poll': 0}
+        self.stacks[stack_id] = {
+            'region': region,
+            'name': stack_name,
+            'status': None,
+            'reason': None,
+            'success_states': success_states,
+            'failure_states': failure_states
+        }
+
+    def _is_done(self, stack):
+        return stack['status'] in stack['success_states'] or stack['status'] in stack['failure_states']
+
+    def _poll(self, region):
+        pending = set([stack_id for stack_id, stack in self.stacks.items() if stack['region']==region and not self._is_done(stack)])
+        statuses = {}
+        next_token = None
+        while pending - set(statuses):
+            self.api_calls += 1
+            params = {'NextToken': next_token} if next_token else {}
+            page = self.regions[region]['client'].list_stacks(**params)
+            for summary in page['StackSummaries']:
+                if summary['StackId'] in pending:
+                    statuses[summary['StackId']] = (summary['StackStatus'], summary.get('StackStatusReason'))
+            next_token = page.get('NextToken')
+            if not next_token:
+                break
+        return statuses
+
+    def wait(self, timeout=None):
+        """
+        Returns a map of each stack id to its final status once all stacks reached one of their terminal states.
+        """
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            pending_regions = set([stack['region'] for stack in self.stacks.values() if not self._is_done(stack)])
+            if not pending_regions:
+                return dict([(stack_id, stack['status']) for stack_id, stack in self.stacks.items()])
+            if deadline and time.time() > deadline:
+                raise OperetoRuntimeError('Timed out waiting for %d stacks' % len([s for s in self.stacks.values() if not self._is_done(s)]))
+
+            for region in sorted(pending_regions):
+                region_state = self.regions[region]
+                if region_state['next_poll'] > time.time():
+                    continue
+                try:
+                    statuses = self._poll(region)
+                except ClientError, e:
+                    if not is_throttling_error(e):
+                        raise
+                    print 'AWS API throttled in region %s, slowing down..' % region
+                    region_state['interval'] = self.max_interval
+                    region_state['next_poll'] = time.time() + self.max_interval
+                    continue
+                progress = False
+                for stack_id, (status, reason) in statuses.items():
+                    stack = self.stacks[stack_id]
+                    if status != stack['status']:
+                        print '%s (%s): %s %s' % (stack['name'], region, status, reason or '')
+                        stack['status'] = status
+                        stack['reason'] = reason
+                        progress = True
+                if progress:
+                    region_state['interval'] = self.min_interval
+                else:
+                    region_state['interval'] = min(region_state['interval'] * BACKOFF_FACTOR, self.max_interval)
+                region_state['next_poll'] = time.time() + region_state['interval'] * random.uniform(0.8, 1.2)
+
+            next_polls = [self.regions[region]['next_poll'] for region in pending_regions]
+            time.sleep(max(0, min(next_polls) - time.time()))
@@ -0,0 +1,240 @@
+import collections
+import os
+import stat
+import threading
+from multiprocessing.pool import ThreadPool
+from opereto.exceptions import OperetoRuntimeError
+from aws_common.checksums import EtagHasher, HashingWriter, send_verified
+
+MB = 1024 * 1024
+STREAM_CHUNKSIZE = 16 * MB
+STREAM_READ_SIZE = MB
+STANDARD_STREAM = '-'
+MAX_BUFFERED_SIZE = 1024 * MB
+
+
+def is_stream_path(path):
+    ## '-' stands for stdin/stdout, named pipes are streamed as well since their size is not known in advance
+    if path == STANDARD_STREAM:
+        return True
+    try:
+        return stat.S_ISFIFO(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+def copy_stream(source, target, read_size=STREAM_READ_SIZE):
+    copied = 0
+    while True:
+        data = source.read(read_size)
+        if not data:
+            break
+        target.write(data)
+        copied += len(data)
+    return copied
+
+
+class BufferLimit(object):
+    """
+    Bounds the bytes of the parts held in memory by all the parallel streamed transfers of a service. A part larger
+    than the whole limit is let through when no other part is held, so that any part size can be transferred.
+    """
+
+    def __init__(self, limit=MAX_BUFFERED_SIZE):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size, blocking=True):
+        with self.condition:
+            while self.used and self.used + size > self.limit:
+                if not blocking:
+                    return False
+                self.condition.wait()
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+def stream_object(client, bucket, key, fileobj, settings, checksums=None, buffers=None):
+    """
+    Writes the content of an s3 object in order to a file-like object (e.g. stdout or a named pipe). Objects over the
+    multipart threshold are fetched as parallel ranged gets of one part each, pinned to the object etag. At most
+    <concurrency> parts are held in memory, and if a BufferLimit shared with other transfers is given, no more than it
+    allows. If a checksum summary is given, the data is verified against the object etag while it is written. Returns
+    the number of bytes written.
+    """
+    head = client.head_object(Bucket=bucket, Key=key)
+    size = head['ContentLength']
+    if checksums:
+        hasher = EtagHasher(size, head['ETag'], settings)
+        fileobj = HashingWriter(fileobj, hasher)
+    chunksize = settings.chunksize(size)
+    if size < settings.threshold() or size <= chunksize:
+        copy_stream(client.get_object(Bucket=bucket, Key=key, IfMatch=head['ETag'])['Body'], fileobj)
+        if checksums:
+            checksums.check(key, hasher, head)
+        return size
+
+    def fetch(byte_range):
+        return client.get_object(Bucket=bucket, Key=key, Range='bytes=%d-%d' % byte_range, IfMatch=head['ETag'])['Body'].read()
+
+    def reserve(byte_range, blocking):
+        return not buffers or buffers.acquire(byte_range[1] - byte_range[0] + 1, blocking)
+
+    def release(byte_range):
+        if buffers:
+            buffers.release(byte_range[1] - byte_range[0] + 1)
+
+    ranges = iter([(start, min(start + chunksize, size) - 1) for start in range(0, size, chunksize)])
+    concurrency = settings.concurrency(size)
+    pool = ThreadPool(concurrency)
+    pending = collections.deque()
+    byte_range = next(ranges, None)
+    try:
+        while True:
+            ## waits for buffer space only when no part is held, so that transfers sharing the limit cannot block each other
+            while byte_range and len(pending) < concurrency and reserve(byte_range, not pending):
+                pending.append((byte_range, pool.apply_async(fetch, (byte_range,))))
+                byte_range = next(ranges, None)
+            if not pending:
+                break
+            fileobj.write(pending[0][1].get())
+            release(pending.popleft()[0])
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+        for fetched_range, result in pending:
+            release(fetched_range)
+    fileobj.flush()
+    if checksums:
+        checksums.check(key, hasher, head)
+    return size
+
+
+class MultipartUploadWriter(object):
+    """
+    A write only file-like object uploading the written bytes as an s3 multipart upload. Parts are uploaded in the
+    background while writing continues, at most <concurrency> parts are held in memory at any time. Data smaller than
+    one part is saved with a single put_object call. If the size of the data is known (file_size), the part size and
+    concurrency are picked by it, and data under the multipart threshold (up to 16MB) is saved with a single put_object
+    call too. If a BufferLimit shared with other transfers is given, the buffered parts are counted against it. If a
+    checksum summary is given, every request body is verified by its md5 (see send_verified).
+    """
+
+    def __init__(self, client, bucket, key, settings, extra_args=None, file_size=None, checksums=None, buffers=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.extra_args = extra_args or {}
+        self.chunksize = settings.chunksize(file_size) if file_size is not None else settings.multipart_chunksize or STREAM_CHUNKSIZE
+        self.concurrency = settings.concurrency(file_size)
+        ## a single put holds the whole data in memory, so the threshold applies up to the size of a stream part
+        self.single_put = file_size is not None and file_size < min(settings.threshold(), STREAM_CHUNKSIZE)
+        self.reservation = max(file_size, 1) if self.single_put else self.chunksize
+        self.checksums = checksums
+        self.buffers = buffers
+        self.reserved = 0
+        self.buffer = []
+        self.buffer_size = 0
+        self.upload_id = None
+        self.parts = []
+        self.results = []
+        self.pool = None
+        self.slots = threading.BoundedSemaphore(self.concurrency)
+        self.bytes_written = 0
+        self.closed = False
+
+    def _send(self, send, data, **kwargs):
+        if self.checksums:
+            return send_verified(send, self.key, data, self.checksums, **kwargs)
+        return send(Body=data, **kwargs)
+
+    def _release(self, reserved):
+        if reserved:
+            self.buffers.release(reserved)
+
+    def _upload_part(self, part_number, data, reserved):
+        try:
+            response = self._send(self.client.upload_part, data, Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            self._release(reserved)
+            self.slots.release()
+
+    def _flush_part(self):
+        ## fail fast on a part that could not be uploaded instead of streaming the rest of the data
+        for result in self.results:
+            if result.ready() and not result.successful():
+                result.get()
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self.extra_args)['UploadId']
+            self.pool = ThreadPool(self.concurrency)
+        self.slots.acquire()
+        data, reserved = ''.join(self.buffer), self.reserved
+        self.buffer = []
+        self.buffer_size = 0
+        self.reserved = 0
+        self.results.append(self.pool.apply_async(self._upload_part, (len(self.results) + 1, data, reserved)))
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed upload stream')
+        if not data:
+            return
+        if self.buffers and not self.buffer:
+            ## the parts being uploaded release their space by themselves, so waiting here cannot block other transfers
+            self.buffers.acquire(self.reservation)
+            self.reserved = self.reservation
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        self.bytes_written += len(data)
+        if self.buffer_size >= self.chunksize and not self.single_put:
+            self._flush_part()
+
+    def flush(self):
+        pass
+
+    def abort(self):
+        self.closed = True
+        self.buffer = []
+        self._release(self.reserved)
+        self.reserved = 0
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+        if self.upload_id:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                self._send(self.client.put_object, ''.join(self.buffer), Bucket=self.bucket, Key=self.key, **self.extra_args)
+                self.closed = True
+                self.buffer = []
+                self._release(self.reserved)
+                self.reserved = 0
+                if self.checksums:
+                    self.checksums.add_verified()
+                return
+            if self.buffer_size:
+                self._flush_part()
+            self.pool.close()
+            self.pool.join()
+            self.parts = [result.get() for result in self.results]
+            self.closed = True
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
+            if self.checksums:
+                self.checksums.add_verified()
+        except Exception, e:
+            self.abort()
+            raise OperetoRuntimeError('Streamed upload to {} failed: {}'.format(self.key, str(e)))
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import re
+import urllib
+import urlparse
+from botocore.exceptions import ClientError
+
+TEMPLATE_BODY_LIMIT = 51200
+TEMPLATE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.opereto', 'cf_templates')
+TEMPLATE_S3_PREFIX = 'opereto-cf-templates'
+
+S3_HOST_PATTERN = re.compile(r'^(?:(?P<bucket>.+)\.)?s3(?:[.-][a-z0-9-]+)?\.amazonaws\.com(?:\.cn)?$')
+
+
+def template_hash(template):
+    return hashlib.sha256(json.dumps(template, sort_keys=True)).hexdigest()
+
+
+class TemplateCache(object):
+    """
+    A small local cache of template processing results (e.g. validation results), stored as one json file per key
+    so that it is shared by services running on the same agent.
+    """
+
+    def __init__(self, cache_dir=TEMPLATE_CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '%s.json' % key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def set(self, key, value):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp_path = '%s.%d.tmp' % (self._path(key), os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(value, f)
+        os.rename(tmp_path, self._path(key))
+
+
+def parse_s3_url(url):
+    ## supports both virtual hosted (bucket.s3.amazonaws.com/key) and path style (s3.amazonaws.com/bucket/key) urls
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme=='s3':
+        return parsed.netloc, parsed.path.lstrip('/')
+    match = S3_HOST_PATTERN.match(parsed.netloc)
+    if parsed.scheme not in ['http', 'https'] or not match:
+        raise ValueError('%s is not an S3 url'%url)
+    path = urlparse.unquote(parsed.path.lstrip('/'))
+    if match.group('bucket'):
+        return match.group('bucket'), path
+    bucket, _, key = path.partition('/')
+    return bucket, key
+
+
+def template_url(url):
+    ## cloud formation only accepts https template urls, s3:// urls are converted to their virtual hosted form
+    if urlparse.urlparse(url).scheme!='s3':
+        return url
+    bucket, key = parse_s3_url(url)
+    return 'https://%s.s3.amazonaws.com/%s' % (bucket, urllib.quote(key))
+
+
+def fetch_template(s3_client, url, cache_dir=TEMPLATE_CACHE_DIR):
+    """
+    Returns the body of a template stored in S3. Bodies are cached by content hash and the url is mapped to
+    the etag of the cached body, so an unchanged template is only checked with a conditional get.
+    """
+    bucket, key = parse_s3_url(url)
+    cache = TemplateCache(cache_dir)
+    url_key = 'url-%s'%hashlib.sha256(url).hexdigest()
+    entry = cache.get(url_key)
+    body_path = None
+    if entry:
+        body_path = os.path.join(cache_dir, '%s.template'%entry['sha256'])
+        if not os.path.exists(body_path):
+            entry = None
+
+    params = {'Bucket': bucket, 'Key': key}
+    if entry:
+        params['IfNoneMatch'] = entry['etag']
+    try:
+        response = s3_client.get_object(**params)
+    except ClientError, e:
+        if entry and e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')==304:
+            with open(body_path) as f:
+                return f.read()
+        raise
+
+    body = response['Body'].read()
+    body_hash = hashlib.sha256(body).hexdigest()
+    body_path = os.path.join(cache_dir, '%s.template'%body_hash)
+    if not os.path.exists(body_path):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = '%s.%d.tmp'%(body_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.rename(tmp_path, body_path)
+    cache.set(url_key, {'etag': response['ETag'], 'sha256': body_hash})
+    return body
+
+
+def upload_template(s3_client, bucket, body):
+    ## templates are stored by content hash, so an unchanged template is uploaded only once
+    key = '%s/%s.json' % (TEMPLATE_S3_PREFIX, hashlib.sha256(body).hexdigest())
+    try:
+        s3_client.head_object(Bucket=bucket, Key=key)
+    except Exception:
+        s3_client.put_object(Bucket=bucket, Key=key, Body=body, ContentType='application/json')
+    return 'https://%s.s3.amazonaws.com/%s' % (bucket, key)
@@ -0,0 +1,125 @@
+import hashlib
+from boto3.s3.transfer import TransferConfig
+
+MB = 1024 * 1024
+GB = 1024 * MB
+DEFAULT_MULTIPART_THRESHOLD = 8 * MB
+DEFAULT_MULTIPART_CHUNKSIZE = 8 * MB
+DEFAULT_PART_CONCURRENCY = 10
+MAX_PARTS = 10000
+MAX_POOL_CONNECTIONS = 200
+
+## service inputs shared by the s3 services, all sizes are in MB and 0 means automatic
+TRANSFER_INPUT_SCHEME = {
+    "multipart_threshold": {
+        "type": ["integer", "null"],
+        "minimum": 0
+    },
+    "multipart_chunksize": {
+        "type": ["integer", "null"],
+        "minimum": 0
+    },
+    "part_concurrency": {
+        "type": ["integer", "null"],
+        "minimum": 0
+    },
+    "max_bandwidth": {
+        "type": ["integer", "null"],
+        "minimum": 0
+    }
+}
+
+
+class TransferSettings(object):
+
+    def __init__(self, input):
+        self.multipart_threshold = (input.get('multipart_threshold') or 0) * MB
+        self.multipart_chunksize = (input.get('multipart_chunksize') or 0) * MB
+        self.part_concurrency = input.get('part_concurrency') or 0
+        self.max_bandwidth = (input.get('max_bandwidth') or 0) * MB
+
+    def threshold(self):
+        return self.multipart_threshold or DEFAULT_MULTIPART_THRESHOLD
+
+    def chunksize(self, file_size=None):
+        if self.multipart_chunksize:
+            chunksize = self.multipart_chunksize
+        elif file_size is None or file_size < 100 * MB:
+            chunksize = DEFAULT_MULTIPART_CHUNKSIZE
+        elif file_size < GB:
+            chunksize = 16 * MB
+        else:
+            chunksize = 64 * MB
+        ## s3 multipart uploads are limited to 10000 parts
+        if file_size and file_size > chunksize * MAX_PARTS:
+            chunksize = -(-file_size // MAX_PARTS)
+            chunksize = -(-chunksize // MB) * MB
+        return chunksize
+
+    def concurrency(self, file_size=None):
+        if self.part_concurrency:
+            return self.part_concurrency
+        if file_size and file_size >= GB:
+            return 2 * DEFAULT_PART_CONCURRENCY
+        return DEFAULT_PART_CONCURRENCY
+
+    def pool_connections(self, file_concurrency=1):
+        ## every parallel file may transfer its parts in parallel over the shared client, so that idle kept-alive
+        ## connections are not dropped the pool fits them all, up to a cap
+        return min(file_concurrency * self.concurrency(GB), MAX_POOL_CONNECTIONS)
+
+    def config(self, file_size=None):
+        kwargs = {
+            'multipart_threshold': self.threshold(),
+            'multipart_chunksize': self.chunksize(file_size),
+            'max_concurrency': self.concurrency(file_size)
+        }
+        if self.max_bandwidth:
+            kwargs['max_bandwidth'] = self.max_bandwidth
+        return TransferConfig(**kwargs)
+
+    def __str__(self):
+        return 'threshold={}, chunksize={}, part concurrency={}, bandwidth={}'.format(
+            '%dMB' % (self.multipart_threshold // MB) if self.multipart_threshold else 'auto',
+            '%dMB' % (self.multipart_chunksize // MB) if self.multipart_chunksize else 'auto',
+            self.part_concurrency or 'auto',
+            '%dMB/s' % (self.max_bandwidth // MB) if self.max_bandwidth else 'unlimited')
+
+
+def compute_etag(path, part_size, read_size=MB):
+    ## computes the etag s3 would assign to the file if uploaded with the given part size, each part is hashed by
+    ## bounded reads so that a single part etag does not load the whole file
+    digests = []
+    with open(path, 'rb') as f:
+        while True:
+            part_hash = hashlib.md5()
+            hashed = 0
+            while hashed < part_size:
+                data = f.read(min(read_size, part_size - hashed))
+                if not data:
+                    break
+                part_hash.update(data)
+                hashed += len(data)
+            if not hashed:
+                break
+            digests.append(part_hash.digest())
+    if not digests:
+        return hashlib.md5('').hexdigest()
+    if len(digests) == 1:
+        return digests[0].encode('hex')
+    return '%s-%d' % (hashlib.md5(''.join(digests)).hexdigest(), len(digests))
+
+
+def etag_part_sizes(size, etag, settings=None):
+    ## candidate part sizes used to produce a multipart etag: the configured/automatic chunk size, the boto3 default,
+    ## then the smallest whole MB size matching the parts count
+    if '-' not in etag:
+        return [size or 1]
+    parts = int(etag.split('-')[1])
+    candidates = [DEFAULT_MULTIPART_CHUNKSIZE]
+    if settings:
+        candidates.insert(0, settings.chunksize(size))
+    part_size = -(-size // parts)
+    part_size = -(-part_size // MB) * MB
+    candidates.append(part_size)
+    return [c for i, c in enumerate(candidates) if c not in candidates[:i] and -(-size // c) == parts]
@@ -0,0 +1,190 @@
+import os,sys
+from multiprocessing.pool import ThreadPool
+from aws_common.clients import get_client
+from aws_common.transfer import TransferSettings, TRANSFER_INPUT_SCHEME
+from aws_common.server_copy import copy_object
+from aws_common.metrics import ServiceMetrics
+from opereto.helpers.services import ServiceTemplate
+from opereto.utils.validations import JsonSchemeValidator
+from opereto.exceptions import *
+
+
+class ServiceRunner(ServiceTemplate):
+
+    def __init__(self, **kwargs):
+        ServiceTemplate.__init__(self, **kwargs)
+
+    def setup(self):
+        self.metrics = ServiceMetrics('aws_copy_in_s3')
+        raise_if_not_ubuntu()
+
+
+    def _print_step_title(self, title):
+        self.metrics.phase(title)
+        ServiceTemplate._print_step_title(self, title)
+
+
+    def validate_input(self):
+        input_scheme = {
+            "type": "object",
+            "properties" : {
+                 "source_bucket": {
+                     "type" : "string",
+                     "minLength": 1
+                 },
+                 "source_path": {
+                     "type" : "string",
+                     "minLength": 1
+                 },
+                 "target_bucket": {
+                     "type" : ["string", "null"]
+                 },
+                 "target_path": {
+                     "type" : ["string", "null"]
+                 },
+                 "source_region": {
+                     "type" : ["string", "null"]
+                 },
+                 "target_region": {
+                     "type" : ["string", "null"]
+                 },
+                 "is_directory": {
+                     "type" : "boolean"
+                 },
+                 "make_public": {
+                     "type" : "boolean"
+                 },
+                 "max_concurrency": {
+                    "type": "integer",
+                    "minimum": 1
+                 },
+                 "aws_access_key": {
+                    "type" : "string",
+                     "minLength": 1
+                 },
+                 "aws_secret_key": {
+                    "type" : "string",
+                     "minLength": 1
+                 },
+                 "metrics_file": {
+                     "type" : ["string", "null"]
+                 },
+                 "required": ['source_bucket', 'source_path', 'aws_access_key','aws_secret_key'],
+                 "additionalProperties": True
+            }
+        }
+        input_scheme['properties'].update(TRANSFER_INPUT_SCHEME)
+        validator = JsonSchemeValidator(self.input, input_scheme)
+        validator.validate()
+
+        self.source_bucket = self.input['source_bucket']
+        self.source_path = self.input['source_path'].lstrip('/')
+        self.target_bucket = self.input.get('target_bucket') or self.source_bucket
+        self.target_path = (self.input.get('target_path') or '').lstrip('/')
+        self.max_concurrency = self.input.get('max_concurrency') or 10
+        self.transfer = TransferSettings(self.input)
+        self.extra_args = {'ACL': 'public-read' if self.input.get('make_public') else 'private'}
+        if self.source_bucket==self.target_bucket and self.source_path==self.target_path:
+            raise OperetoRuntimeError('The source and target of the copy are the same')
+        if self.input['is_directory'] and self.source_bucket==self.target_bucket and self._is_in_source(self.target_path):
+            ## the source prefix is listed while its files are copied, copies created under it would be copied again
+            raise OperetoRuntimeError('The target path {} is inside the copied directory {}'.format(self.target_path, self.source_path or '/'))
+
+        ## copy requests are sent to the target bucket region, the source bucket is listed in its own region
+        pool_connections = self.transfer.pool_connections(self.max_concurrency)
+        self.source_client = self.metrics.instrument(get_client('s3', self.input['aws_access_key'], self.input['aws_secret_key'],
+                                                                self.input.get('source_region'), max_pool_connections=pool_connections))
+        self.target_client = self.metrics.instrument(get_client('s3', self.input['aws_access_key'], self.input['aws_secret_key'],
+                                                                self.input.get('target_region') or self.input.get('source_region'),
+                                                                max_pool_connections=pool_connections))
+
+
+    def _is_in_source(self, path):
+        source_prefix = self.source_path.rstrip('/')
+        path = path.rstrip('/')
+        return not source_prefix or path==source_prefix or path.startswith(source_prefix + '/')
+
+
+    def _target_key(self, key):
+        if not self.input['is_directory']:
+            if not self.target_path or self.target_path.endswith('/'):
+                return self.target_path + os.path.basename(key)
+            return self.target_path
+        relative_key = key[len(self.source_path):].lstrip('/')
+        if not self.target_path:
+            return relative_key
+        return '%s/%s' % (self.target_path.rstrip('/'), relative_key)
+
+
+    def _list_source_objects(self):
+        prefix = self.source_path
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        paginator = self.source_client.get_paginator('list_objects_v2')
+        for result in paginator.paginate(Bucket=self.source_bucket, Prefix=prefix):
+            for obj in result.get('Contents') or []:
+                if obj['Key'].endswith('/'):
+                    continue
+                yield obj['Key'], obj['Size'], obj['ETag']
+
+
+    def _copy_object(self, item):
+        key, size, etag = item
+        try:
+            copy_object(self.target_client, self.source_bucket, key, self.target_bucket, self._target_key(key), size, etag,
+                        self.transfer, extra_args=self.extra_args, source_client=self.source_client)
+        except Exception, e:
+            return key, size, str(e)
+        self.metrics.incr('files_transferred')
+        self.metrics.incr('bytes_transferred', size)
+        return key, size, None
+
+
+    def _copy_objects(self, objects):
+        copied = 0
+        copied_bytes = 0
+        failures = {}
+        pool = ThreadPool(self.max_concurrency)
+        try:
+            for key, size, error in pool.imap_unordered(self._copy_object, objects):
+                if error:
+                    failures[key] = error
+                else:
+                    copied += 1
+                    copied_bytes += size
+        finally:
+            pool.close()
+            pool.join()
+        return copied, copied_bytes, failures
+
+
+    def process(self):
+
+        self._print_step_title('Copying s3 data..')
+        if self.input['is_directory']:
+            print 'Copying the content of {} in bucket {} to {} in bucket {} ({} parallel copies)..'.format(
+                self.source_path, self.source_bucket, self.target_path, self.target_bucket, self.max_concurrency)
+            objects = self._list_source_objects()
+        else:
+            print 'Copying {} in bucket {} to {} in bucket {}..'.format(self.source_path, self.source_bucket, self._target_key(self.source_path), self.target_bucket)
+            head = self.source_client.head_object(Bucket=self.source_bucket, Key=self.source_path)
+            objects = [(self.source_path, head['ContentLength'], head['ETag'])]
+
+        copied, copied_bytes, failures = self._copy_objects(objects)
+        print '{} objects copied ({} bytes).'.format(copied, copied_bytes)
+        if failures:
+            for key, error in sorted(failures.items()):
+                print >> sys.stderr, 'Failed to copy {}: {}'.format(key, error)
+            print >> sys.stderr, '{} objects failed to copy.'.format(len(failures))
+            return self.client.FAILURE
+
+        print 'Operation completed successfuly.'
+        return self.client.SUCCESS
+
+    def teardown(self):
+        self.metrics.publish(self.client, self.input.get('metrics_file'), pid=self.input.get('pid'))
+
+
+
+if __name__ == "__main__":
+    exit(ServiceRunner().run())
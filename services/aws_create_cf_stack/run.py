@@ -1,24 +1,116 @@
-import boto
-import boto.cloudformation
-import boto.ec2
+import copy
 import json
+import re
 import time
 import sys
 import uuid
-import socket
+from multiprocessing.pool import ThreadPool
+from botocore.exceptions import ClientError
+from aws_common.clients import get_client
+from aws_common.stack_waiter import StackWaiter, MultiStackWaiter, CREATE_SUCCESS_STATES, CREATE_FAILURE_STATES, UPDATE_SUCCESS_STATES, UPDATE_FAILURE_STATES
+from aws_common.reachability import probe_ports
+from aws_common.templates import TemplateCache, TEMPLATE_BODY_LIMIT, template_hash, upload_template, fetch_template, parse_s3_url, template_url
+from aws_common.metrics import ServiceMetrics
 from opereto.helpers.services import ServiceTemplate
 from opereto.utils.validations import JsonSchemeValidator, default_variable_name_scheme, default_entity_name_scheme, default_entity_description_scheme
-from opereto.utils.misc import retry
 from opereto.exceptions import *
 
+INSTANCES_BATCH_SIZE = 200
+INSTANCES_POLL_INTERVAL = 10
+AGENT_MIN_POLL_INTERVAL = 5
+AGENT_MAX_POLL_INTERVAL = 30
+AGENT_MAX_PARALLEL_CHECKS = 20
+CHANGE_SET_POLL_INTERVAL = 3
+NO_CHANGES_REASONS = ["didn't contain changes", 'No updates are to be performed']
+
+## instance attributes keep the names used by the boto2 instance object, since agent properties are named after them
+BOTO2_INSTANCE_ATTRIBUTES = {'InstanceId': 'id', 'PublicIpAddress': 'ip_address', 'PublicDnsName': 'dns_name'}
+
+
+def instance_tags(instance):
+    return dict([(tag['Key'], tag['Value']) for tag in instance.get('Tags') or []])
+
+
+def instance_properties(instance):
+    ## flattens an ec2 instance description to the aws_<attribute> agent properties
+    properties = {}
+    for key, value in instance.items():
+        if isinstance(value, (dict, list)):
+            continue
+        name = BOTO2_INSTANCE_ATTRIBUTES.get(key) or re.sub('(?<!^)([A-Z])', r'_\1', key).lower()
+        properties['aws_'+name] = str(value)
+    properties['aws_state'] = instance['State']['Name']
+    properties['aws_placement'] = instance.get('Placement', {}).get('AvailabilityZone')
+    return properties
+
+
+class AgentReadinessTracker(object):
+    """
+    Polls all pending agents concurrently until each one is confirmed or passes its own deadline. Confirmed agents
+    are not queried again, the poll interval grows while no new agent is confirmed.
+    """
+
+    def __init__(self, client, deadlines):
+        self.client = client
+        self.deadlines = deadlines
+        self.confirmed = set()
+        self.failed = set()
+
+    def _check(self, agent_name):
+        try:
+            self.client.get_agent_properties(agent_name)
+        except Exception:
+            return agent_name, False
+        return agent_name, True
+
+    def wait(self):
+        pending = set(self.deadlines)
+        if not pending:
+            return []
+        interval = AGENT_MIN_POLL_INTERVAL
+        pool = ThreadPool(min(AGENT_MAX_PARALLEL_CHECKS, len(pending)))
+        try:
+            while True:
+                progress = False
+                for agent_name, ready in pool.imap_unordered(self._check, sorted(pending)):
+                    if ready:
+                        print 'Agent %s is up and running.'%agent_name
+                        pending.discard(agent_name)
+                        self.confirmed.add(agent_name)
+                        progress = True
+                now = time.time()
+                for agent_name in sorted(pending):
+                    if now > self.deadlines[agent_name]:
+                        print >> sys.stderr, 'Agent %s did not connect in time.'%agent_name
+                        pending.discard(agent_name)
+                        self.failed.add(agent_name)
+                if not pending:
+                    break
+                interval = AGENT_MIN_POLL_INTERVAL if progress else min(interval * 1.5, AGENT_MAX_POLL_INTERVAL)
+                print '%d agents are not up yet (%s). Recheck in %d seconds..'%(len(pending), ', '.join(sorted(pending)), interval)
+                time.sleep(interval)
+        finally:
+            pool.close()
+            pool.join()
+        return sorted(self.failed)
+
+
 class ServiceRunner(ServiceTemplate):
 
     def __init__(self, **kwargs):
         ServiceTemplate.__init__(self, **kwargs)
 
     def setup(self):
+        self.metrics = ServiceMetrics('aws_create_cf_stack')
         raise_if_not_ubuntu()
         self.agents = {}
+        self.agents_running_time = {}
+        self.agents_resources = {}
+
+
+    def _print_step_title(self, title):
+        self.metrics.phase(title)
+        ServiceTemplate._print_step_title(self, title)
 
     def validate_input(self):
         input_scheme = {
@@ -33,6 +125,9 @@ class ServiceRunner(ServiceTemplate):
                 },
                 "cf_template_url": {
                     "type": ["string", "null"]
+                },
+                "cf_template_bucket": {
+                    "type": ["string", "null"]
                 },
                  "opereto_core_tools": {
                     "type" : "boolean"
@@ -57,6 +152,29 @@ class ServiceRunner(ServiceTemplate):
                 },
                 "disable_rollback": {
                     "type": "boolean"
+                },
+                "update_stack": {
+                    "type": "boolean"
+                },
+                "cf_stacks": {
+                    "type": ["array", "null"],
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "cf_stack_name": {
+                                "type": "string",
+                                "minLength": 1
+                            },
+                            "aws_region": {
+                                "type": ["string", "null"]
+                            },
+                            "cf_parameters": {
+                                "type": ["object", "null"]
+                            }
+                        },
+                        "required": ['cf_stack_name'],
+                        "additionalProperties": True
+                    }
                 },
                  "cf_capabilities": {
                     "type" : ["string", "null"]
@@ -82,6 +200,33 @@ class ServiceRunner(ServiceTemplate):
                     "type" : "string",
                      "minLength": 1
                  },
+                 "max_parallel_installs": {
+                     "type": ["integer", "null"],
+                     "minimum": 1
+                 },
+                 "install_retries": {
+                     "type": ["integer", "null"],
+                     "minimum": 0
+                 },
+                 "agent_install_timeout": {
+                     "type": ["integer", "null"],
+                     "minimum": 1
+                 },
+                 "connectivity_ports": {
+                     "type": ["string", "integer", "null"],
+                     "pattern": "^( *\\d+ *(, *\\d+ *)*)?$"
+                 },
+                 "connectivity_timeout": {
+                     "type": ["integer", "null"],
+                     "minimum": 1
+                 },
+                 "connectivity_attempts": {
+                     "type": ["integer", "null"],
+                     "minimum": 1
+                 },
+                 "metrics_file": {
+                     "type" : ["string", "null"]
+                 },
                  "required": ['aws_access_key','aws_secret_key', 'aws_region'],
                  "additionalProperties": True
             }
@@ -97,58 +242,128 @@ class ServiceRunner(ServiceTemplate):
 
         self.install_core_tools = self.input['install_core_tools']
         self.install_container_tools = self.input['install_container_tools']
+        self.max_parallel_installs = self.input.get('max_parallel_installs') or 10
+        self.install_retries = self.input.get('install_retries') or 0
         self.agent_valid_os = ['linux', 'windows']
-        self.cf_capabilities = self.input['cf_capabilities'].split(',')
+        self.cf_capabilities = [capability.strip() for capability in self.input['cf_capabilities'].split(',') if capability.strip()]
         self.cf_globals = self.input['cf_globals']
 
+        ## parsed before any stack is created, so that a bad value does not roll back a created stack
+        connectivity_ports = str(self.input.get('connectivity_ports') or '22')
+        try:
+            self.connectivity_ports = [int(port) for port in connectivity_ports.split(',') if port.strip()]
+        except ValueError:
+            raise OperetoRuntimeError('Invalid connectivity ports: %s'%connectivity_ports)
+        if [port for port in self.connectivity_ports if not 0 < port < 65536]:
+            raise OperetoRuntimeError('Invalid connectivity ports: %s'%connectivity_ports)
+
         if self.install_container_tools and not self.install_core_tools:
             raise Exception, 'Opereto container tools is dependant on opereto core tools. Please check the "install_core_tools" checkbox too.'
 
+        self._print_step_title('Connecting to AWS..')
+        self.cf_client, self.ec2_client = self._connect_to_region(self.input['aws_region'])
+        print 'Connected.'
+
+        ## in update mode, agents of existing instances keep their identifiers so that their instances are not modified
+        self.update_stack = self.input.get('update_stack')
+        self.cf_stacks = self.input.get('cf_stacks')
+        if self.cf_stacks and self.update_stack:
+            raise OperetoRuntimeError('Update mode is not supported when creating several stacks (cf_stacks)')
+        self.existing_agent_ids = {}
+        if self.update_stack:
+            self.existing_agent_ids = self._existing_agent_ids(self.input['cf_stack_name'])
+
         source_user = self.client.input['opereto_originator_username']
         self.users = [source_user]
         self.owners = [source_user]
 
-        def windows_user_data(agent_name):
-            data = [
-                "<powershell>",
-                "Add-Type -AssemblyName System.IO.Compression.FileSystem",
-                "function Unzip",
-                "{",
-                "    param([string]$zipfile, [string]$outpath)",
-                "    [System.IO.Compression.ZipFile]::ExtractToDirectory($zipfile, $outpath)",
-                "}",
-                "$MyDir = \"c:\"",
-                "$filename = Join-Path -Path $MyDir -ChildPath \"opereto-agent-latest.zip\"",
-                "$WebClient = New-Object System.Net.WebClient",
-                "$WebClient.DownloadFile(\"%s\", \"$filename\")" %(self.input['agent_package_url']['windows']),
-                "Unzip \"$MyDir\opereto-agent-latest.zip\" \"$MyDir\opereto\"",
-                "cd \"$MyDir\opereto\opereto-agent-latest\"",
-                "./opereto-install.bat %s %s %s javaw" %(self.input['opereto_host'], self.input['opereto_token'], agent_name),
-                "./opereto-start.bat",
-                "Remove-Item $filename",
-                "</powershell>",
-                "<persist>true</persist>"
-            ]
-            return data
-
-
-        def linux_user_data(agent_name):
-
-            data = [
-                "#!/bin/bash -x",
-                "exec > >(tee /var/log/user-data.log|logger -t user-data -s 2>/dev/console) 2>&1",
-                "sed --in-place /requiretty/d /etc/sudoers",
-                "cd /tmp",
-                "curl -O %s" %(self.input['agent_package_url']['linux']),
-                "tar -zxvf opereto-agent-latest.tar.gz",
-                "cd opereto-agent-latest",
-                "sudo chmod 777 -R *",
-                "./install.sh -h %s -t %s -n %s"%(self.input['opereto_host'], self.input['opereto_token'], agent_name)
-            ]
-            return data
-
-        if "Resources" in self.cf_template:
-            for resource_name, resource_data in self.cf_template['Resources'].items():
+        ## url templates are fetched so that the agents can be injected to them as well
+        self.source_template = None
+        if not self.cf_template:
+            self._print_step_title('Fetching cloud formation template..')
+            try:
+                body = fetch_template(self._client('s3'), self.cf_template_url)
+            except ValueError, e:
+                raise OperetoRuntimeError(str(e))
+            try:
+                self.cf_template = json.loads(body)
+                self.source_template = copy.deepcopy(self.cf_template)
+            except ValueError:
+                print 'The template at %s is not a json document, it is passed by url as is (no agents are installed).'%self.cf_template_url
+            else:
+                print 'Fetched template %s (%d bytes).'%(self.cf_template_url, len(body))
+
+        self.template_cache = TemplateCache()
+        self.template_validation = None
+        self.template_hash = None
+        if self.cf_template:
+            self.template_hash = template_hash(self.cf_template)
+            self.template_validation = self.template_cache.get('validation-%s'%self.template_hash)
+
+        if self.cf_stacks:
+            self.stacks = []
+            for entry in self.cf_stacks:
+                template = copy.deepcopy(self.cf_template)
+                agents = self._prepare_template(template, entry['cf_stack_name'], unique_names=True)
+                self.stacks.append({
+                    'cf_stack_name': entry['cf_stack_name'],
+                    'aws_region': entry.get('aws_region') or self.input['aws_region'],
+                    'cf_parameters': entry.get('cf_parameters') or {},
+                    'template_params': self._template_params(template),
+                    'agents': agents
+                })
+        else:
+            self._prepare_template(self.cf_template, self.input['cf_stack_name'])
+            self.template_params = self._template_params(self.cf_template)
+
+
+
+
+    def _windows_user_data(self, agent_name):
+        data = [
+            "<powershell>",
+            "Add-Type -AssemblyName System.IO.Compression.FileSystem",
+            "function Unzip",
+            "{",
+            "    param([string]$zipfile, [string]$outpath)",
+            "    [System.IO.Compression.ZipFile]::ExtractToDirectory($zipfile, $outpath)",
+            "}",
+            "$MyDir = \"c:\"",
+            "$filename = Join-Path -Path $MyDir -ChildPath \"opereto-agent-latest.zip\"",
+            "$WebClient = New-Object System.Net.WebClient",
+            "$WebClient.DownloadFile(\"%s\", \"$filename\")" %(self.input['agent_package_url']['windows']),
+            "Unzip \"$MyDir\opereto-agent-latest.zip\" \"$MyDir\opereto\"",
+            "cd \"$MyDir\opereto\opereto-agent-latest\"",
+            "./opereto-install.bat %s %s %s javaw" %(self.input['opereto_host'], self.input['opereto_token'], agent_name),
+            "./opereto-start.bat",
+            "Remove-Item $filename",
+            "</powershell>",
+            "<persist>true</persist>"
+        ]
+        return data
+
+
+    def _linux_user_data(self, agent_name):
+
+        data = [
+            "#!/bin/bash -x",
+            "exec > >(tee /var/log/user-data.log|logger -t user-data -s 2>/dev/console) 2>&1",
+            "sed --in-place /requiretty/d /etc/sudoers",
+            "cd /tmp",
+            "curl -O %s" %(self.input['agent_package_url']['linux']),
+            "tar -zxvf opereto-agent-latest.tar.gz",
+            "cd opereto-agent-latest",
+            "sudo chmod 777 -R *",
+            "./install.sh -h %s -t %s -n %s"%(self.input['opereto_host'], self.input['opereto_token'], agent_name)
+        ]
+        return data
+
+
+    def _prepare_template(self, template, stack_name, unique_names=False):
+        ## adds the agent installation user data and tags to the template instances, returns the names of the agents to install
+        agents = []
+        if template and "Resources" in template:
+            for resource_name, resource_data in template['Resources'].items():
                 if resource_data["Type"]=="AWS::EC2::Instance":
 
                     agent_os=None
@@ -168,10 +383,12 @@ class ServiceRunner(ServiceTemplate):
                             agent_description=tag['Value']
 
                     if agent_os:
+                        if agent_id_found and unique_names:
+                            raise OperetoRuntimeError('OperetoAgentId tags can not be used when creating several stacks from the same template')
                         if agent_os not in self.agent_valid_os:
                             raise OperetoRuntimeError('OperetoAgentOs must be one of the following: {}'.format(str(self.agent_valid_os)))
                         if not agent_name:
-                            agent_name = 'agent'+str(uuid.uuid4())[:10]
+                            agent_name = self.existing_agent_ids.get(resource_name) or 'agent'+str(uuid.uuid4())[:10]
                         else:
                             try:
                                 JsonSchemeValidator(agent_name, default_variable_name_scheme).validate()
@@ -189,134 +406,412 @@ class ServiceRunner(ServiceTemplate):
                                 raise OperetoRuntimeError('Invalid agent description: {}'.format(str(e)))
 
                         if agent_os=='windows':
-                            agent_data = windows_user_data(agent_name)
+                            agent_data = self._windows_user_data(agent_name)
                         else:
-                            agent_data = linux_user_data(agent_name)
+                            agent_data = self._linux_user_data(agent_name)
 
                         ## currently override user data, add fix to handle addition to existing user data
                         ##
                         ##
-                        self.cf_template["Resources"][resource_name]["Properties"]["UserData" ] = {
+                        template["Resources"][resource_name]["Properties"]["UserData" ] = {
                             "Fn::Base64": {
                                 "Fn::Join": ["\n", agent_data]
                             }
                         }
                         if not agent_id_found:
-                            self.cf_template["Resources"][resource_name]["Properties"]["Tags" ].append({
+                            template["Resources"][resource_name]["Properties"]["Tags" ].append({
                                 "Key": "OperetoAgentId",
                                 "Value": agent_name
                             })
 
                         self.agents[agent_name]={
-                            'cf_stack_name': self.input['cf_stack_name'],
+                            'cf_stack_name': stack_name,
                             'agent_display_name': agent_display_name,
                             'agent_description': agent_description
                         }
+                        self.agents_resources[agent_name]=resource_name
+                        agents.append(agent_name)
+        return agents
+
+
+    def _client(self, service_name, region=None):
+        return self.metrics.instrument(get_client(service_name, self.input['aws_access_key'], self.input['aws_secret_key'], region or self.input['aws_region']))
 
-        self._print_step_title('Connecting to AWS..')
-        self.cf_conn = boto.cloudformation.connect_to_region(self.input['aws_region'], aws_access_key_id=self.input['aws_access_key'],
-                                                        aws_secret_access_key=self.input['aws_secret_key'])
-        self.ec2_conn = boto.ec2.connect_to_region(self.input['aws_region'], aws_access_key_id=self.input['aws_access_key'], aws_secret_access_key=self.input['aws_secret_key'])
-        print 'Connected.'
 
+    def _connect_to_region(self, region):
+        return self._client('cloudformation', region), self._client('ec2', region)
 
 
+    def _validate_template(self, template_params):
+        ## fails in seconds on template errors or missing capabilities, instead of after a stack rollback
+        if self.template_validation is None:
+            print 'Validating the cloud formation template..'
+            try:
+                result = self.cf_client.validate_template(**template_params)
+            except ClientError, e:
+                raise OperetoRuntimeError('Invalid cloud formation template: %s'%e.response.get('Error', {}).get('Message', str(e)))
+            self.template_validation = {
+                'capabilities': result.get('Capabilities') or [],
+                'capabilities_reason': result.get('CapabilitiesReason')
+            }
+            if self.template_hash:
+                self.template_cache.set('validation-%s'%self.template_hash, self.template_validation)
+
+        ## CAPABILITY_NAMED_IAM is a superset of CAPABILITY_IAM
+        granted_capabilities = set(self.cf_capabilities)
+        if 'CAPABILITY_NAMED_IAM' in granted_capabilities:
+            granted_capabilities.add('CAPABILITY_IAM')
+        missing_capabilities = set(self.template_validation['capabilities']) - granted_capabilities
+        if missing_capabilities:
+            raise OperetoRuntimeError('The cloud formation template requires the following capabilities: %s (%s)'%(
+                ','.join(sorted(missing_capabilities)), self.template_validation['capabilities_reason']))
+
+
+    def _template_params(self, template):
+        ## returns the create_stack template parameters, templates above the inline body size limit are passed by url
+        if not template or template==self.source_template:
+            ## url templates without agents are passed by their original url
+            template_params = {'TemplateURL': template_url(self.cf_template_url)}
+        else:
+            body = json.dumps(template)
+            ## templates fetched from S3 are uploaded back to their own bucket unless cf_template_bucket is set
+            template_bucket = self.input.get('cf_template_bucket')
+            if not template_bucket and self.cf_template_url:
+                try:
+                    template_bucket = parse_s3_url(self.cf_template_url)[0]
+                except ValueError:
+                    pass
+            if len(body) <= TEMPLATE_BODY_LIMIT:
+                template_params = {'TemplateBody': body}
+            elif template_bucket:
+                template_params = {'TemplateURL': upload_template(self._client('s3'), template_bucket, body)}
+                print 'The template exceeds %d bytes, uploaded to %s'%(TEMPLATE_BODY_LIMIT, template_params['TemplateURL'])
+            else:
+                raise OperetoRuntimeError('The cloud formation template exceeds %d bytes, please provide cf_template_bucket to upload it to S3.'%TEMPLATE_BODY_LIMIT)
+        self._validate_template(template_params)
+        return template_params
+
+
+    def _stack_instances(self, stack_id, cf_client=None):
+        ## maps the logical resource id of each stack instance to its physical instance id
+        instances = {}
+        next_token = None
+        while True:
+            params = {'StackName': stack_id}
+            if next_token:
+                params['NextToken'] = next_token
+            page = (cf_client or self.cf_client).list_stack_resources(**params)
+            for resource in page['StackResourceSummaries']:
+                if resource['ResourceType']=='AWS::EC2::Instance' and resource.get('PhysicalResourceId'):
+                    instances[resource['LogicalResourceId']] = resource['PhysicalResourceId']
+            next_token = page.get('NextToken')
+            if not next_token:
+                break
+        return instances
+
+
+    def _describe_instances(self, instance_ids, ec2_client=None):
+        ## instances are described in batches, with a single call per batch of instance ids
+        for i in range(0, len(instance_ids), INSTANCES_BATCH_SIZE):
+            response = (ec2_client or self.ec2_client).describe_instances(InstanceIds=instance_ids[i:i+INSTANCES_BATCH_SIZE])
+            for reservation in response['Reservations']:
+                for instance in reservation['Instances']:
+                    yield instance
+
+
+    def _existing_agent_ids(self, stack_id):
+        resources = dict((physical_id, logical_id) for logical_id, physical_id in self._stack_instances(stack_id).items())
+        instance_ids = sorted(resources)
+        agent_ids = {}
+        for instance in self._describe_instances(instance_ids):
+            tags = instance_tags(instance)
+            if tags.get('OperetoAgentId'):
+                agent_ids[resources[instance['InstanceId']]] = tags['OperetoAgentId']
+        return agent_ids
+
+
+    def _change_set_params(self, stack_params):
+        ## create_change_set takes the create_stack parameters, except for the rollback setting
+        return dict([(key, value) for key, value in stack_params.items() if key!='DisableRollback'])
+
+
+    def _wait_for_change_set(self, change_set_name):
+        while True:
+            change_set = self.cf_client.describe_change_set(ChangeSetName=change_set_name, StackName=self.stack_full_id)
+            if change_set['Status'] in ['CREATE_COMPLETE', 'FAILED']:
+                break
+            time.sleep(CHANGE_SET_POLL_INTERVAL)
+        changes = change_set.get('Changes', [])
+        while change_set.get('NextToken'):
+            change_set = self.cf_client.describe_change_set(ChangeSetName=change_set_name, StackName=self.stack_full_id, NextToken=change_set['NextToken'])
+            changes += change_set.get('Changes', [])
+        change_set['Changes'] = changes
+        return change_set
+
+
+    def _update_stack(self, stack_params):
+        ## updates the stack with a change set, only agents of new or replaced instances are registered again
+        stack = self.cf_client.describe_stacks(StackName=self.input['cf_stack_name'])['Stacks'][0]
+        self.stack_full_id = stack['StackId']
+        old_instances = self._stack_instances(self.stack_full_id)
+
+        change_set_name = 'opereto-%s'%uuid.uuid4().hex[:12]
+        self.cf_client.create_change_set(StackName=self.stack_full_id, ChangeSetName=change_set_name, ChangeSetType='UPDATE',
+                                         **self._change_set_params(stack_params))
+        change_set = self._wait_for_change_set(change_set_name)
+        if change_set['Status']=='FAILED':
+            reason = change_set.get('StatusReason') or ''
+            if not [r for r in NO_CHANGES_REASONS if r in reason]:
+                raise OperetoRuntimeError('Failed to create the stack change set: %s'%reason)
+            print 'The stack is up to date, no changes to apply.'
+            self.cf_client.delete_change_set(ChangeSetName=change_set_name, StackName=self.stack_full_id)
+            self.agents = {}
+            return stack
+
+        print 'Planned changes:'
+        for change in change_set['Changes']:
+            rc = change['ResourceChange']
+            replacement = ' (replacement: %s)'%rc['Replacement'] if rc.get('Replacement') else ''
+            print '  %s %s [%s]%s'%(rc['Action'], rc['LogicalResourceId'], rc['ResourceType'], replacement)
+
+        ## the stack history is skipped, so that only the events of this update are printed and reported on failure
+        waiter = StackWaiter(self.cf_client, self.stack_full_id)
+        waiter.skip_existing_events()
+        self.cf_client.execute_change_set(ChangeSetName=change_set_name, StackName=self.stack_full_id)
+        self._print_step_title('Waiting for cloud formation update to complete (may take few minutes)..')
+        stack = waiter.wait(UPDATE_SUCCESS_STATES, UPDATE_FAILURE_STATES)
+        if stack['StackStatus'] in UPDATE_FAILURE_STATES:
+            self.stack_output['cf_error']='\n'.join(['%s [%s]: %s'%(e['LogicalResourceId'], e['ResourceStatus'], e.get('ResourceStatusReason')) for e in waiter.events])
+            print >> sys.stderr, 'Cloud formation stack update failed (%s).'%stack['StackStatus']
+            return None
+
+        new_instances = self._stack_instances(self.stack_full_id)
+        changed_resources = set([logical_id for logical_id, physical_id in new_instances.items() if old_instances.get(logical_id)!=physical_id])
+        self.agents = dict([(agent_name, attr) for agent_name, attr in self.agents.items() if self.agents_resources[agent_name] in changed_resources])
+        print 'Cloud formation stack has been updated successfully, %d agent instances were added or replaced.'%len(self.agents)
+        return stack
+
+
+    def _wait_for_instances(self, stacks):
+        ## the instances of all the given (stack id, region) pairs are checked together, with a single describe call
+        ## per batch of instance ids of each region, so that several stacks are waited for as long as the slowest one
+        regions = {}
+        for stack_id, region in stacks:
+            cf_client, ec2_client = self._connect_to_region(region)
+            regions.setdefault(region, {'client': ec2_client, 'pending': set()})
+            regions[region]['pending'].update(self._stack_instances(stack_id, cf_client).values())
+        total = sum([len(region['pending']) for region in regions.values()])
+        print 'Waiting for %d instances..'%total
+        while True:
+            for region, attr in regions.items():
+                if not attr['pending']:
+                    continue
+                for instance in self._describe_instances(sorted(attr['pending']), attr['client']):
+                    state = instance['State']['Name']
+                    if state in ['shutting-down', 'terminated', 'stopping', 'stopped']:
+                        raise OperetoRuntimeError('Instance %s is %s'%(instance['InstanceId'], state))
+                    if state!='running':
+                        continue
+                    attr['pending'].discard(instance['InstanceId'])
+                    self.metrics.incr('instances')
+                    agent_name = instance_tags(instance).get('OperetoAgentId')
+                    if agent_name in self.agents:
+                        self.agents_running_time[agent_name] = time.time()
+                        self.agents[agent_name].update(instance_properties(instance))
+                        self.agents[agent_name]['aws_region']=region
+            pending = sum([len(region['pending']) for region in regions.values()])
+            if not pending:
+                break
+            print '%d of %d instances are running..'%(total-pending, total)
+            time.sleep(INSTANCES_POLL_INTERVAL)
+
+
+    def _resolve_globals(self, cf_params):
+        ## parameter values of the form cf_globals.<name> are replaced by the named cf_globals value
+        cf_params = dict(cf_params)
+        if self.cf_globals:
+            for key,val in cf_params.items():
+                if val.startswith('cf_globals.'):
+                    cf_params[key] = self.cf_globals.get(val[len('cf_globals.'):])
+        return cf_params
+
+
+    def _create_stacks(self, stack_params):
+        ## creates all cf_stacks entries at once and waits for all of them with a single poller,
+        ## stack outputs and ids are reported per stack name
+        waiter = MultiStackWaiter()
+        for stack in self.stacks:
+            params = dict(stack_params)
+            cf_params = dict([(param['ParameterKey'], param['ParameterValue']) for param in params.get('Parameters') or []])
+            cf_params.update(self._resolve_globals(stack['cf_parameters']))
+            if cf_params:
+                params['Parameters'] = [{'ParameterKey': key, 'ParameterValue': val} for key, val in cf_params.items()]
+            params.update(stack['template_params'])
+            cf_client, ec2_client = self._connect_to_region(stack['aws_region'])
+            stack['stack_id'] = cf_client.create_stack(StackName=stack['cf_stack_name'], **params)['StackId']
+            print 'Stack %s created in region %s (%s)'%(stack['cf_stack_name'], stack['aws_region'], stack['stack_id'])
+            self.metrics.incr('stacks_created')
+            waiter.add(stack['aws_region'], cf_client, stack['stack_id'], stack['cf_stack_name'], CREATE_SUCCESS_STATES, CREATE_FAILURE_STATES)
+
+        self._print_step_title('Waiting for cloud formation initiation of %d stacks to complete (may take few minutes)..'%len(self.stacks))
+        statuses = waiter.wait()
+        failed_stacks = []
+        for stack in self.stacks:
+            self.stack_output[stack['cf_stack_name']] = {}
+            if statuses[stack['stack_id']] in CREATE_FAILURE_STATES:
+                reason = waiter.stacks[stack['stack_id']]['reason']
+                self.stack_output[stack['cf_stack_name']]['cf_error'] = '%s: %s'%(statuses[stack['stack_id']], reason)
+                failed_stacks.append(stack['cf_stack_name'])
+        if failed_stacks:
+            raise OperetoRuntimeError('Failed to create cloud formation stacks: %s'%', '.join(failed_stacks))
+        print 'All cloud formation stacks have been created successfully..'
+
+        self._print_step_title('Waiting that all instances will be up..')
+        for stack in self.stacks:
+            cf_client, ec2_client = self._connect_to_region(stack['aws_region'])
+            for output_obj in cf_client.describe_stacks(StackName=stack['stack_id'])['Stacks'][0].get('Outputs', []):
+                self.stack_output[stack['cf_stack_name']][output_obj['OutputKey']]=output_obj['OutputValue']
+            for agent_name in stack['agents']:
+                self.agents[agent_name]['cf_stack_id']=stack['stack_id']
+        self._wait_for_instances([(stack['stack_id'], stack['aws_region']) for stack in self.stacks])
+        print 'All instances are running.'
+        self.client.modify_process_property('stack_id', dict([(stack['cf_stack_name'], stack['stack_id']) for stack in self.stacks]))
+
+
+    def _install_steps(self):
+        steps = [('install_opereto_worker_libs', 'Installing opereto worker libraries on agent {}')]
+        if self.install_container_tools:
+            steps.append(('install_docker_on_host', 'Installing opereto container tools on agent {}'))
+        return steps
+
+
+    def _install_agent_tools(self, agent_name):
+        ## runs the install steps of a single agent one after the other, each step is retried on this agent only
+        for service, title in self._install_steps():
+            title = title.format(agent_name)
+            for attempt in range(self.install_retries + 1):
+                if attempt:
+                    print '%s failed, retrying (%d/%d)..'%(title, attempt, self.install_retries)
+                try:
+                    pid = self.client.create_process(service=service, agent=agent_name, title=title)
+                    if self.client.is_success([pid]):
+                        break
+                except Exception, e:
+                    print >> sys.stderr, '%s: %s'%(title, str(e))
+            else:
+                return agent_name, title
+        print 'Opereto tools installed on agent %s.'%agent_name
+        self.metrics.incr('agents_installed')
+        return agent_name, None
+
+
+    def _install_tools(self):
+        ## each agent moves to its next install step as soon as its own previous step succeeded,
+        ## the number of agents installing at the same time is limited to protect the opereto server
+        failed_agents = {}
+        if not self.agents:
+            return failed_agents
+        pool = ThreadPool(min(self.max_parallel_installs, len(self.agents)))
+        try:
+            for agent_name, failed_step in pool.imap_unordered(self._install_agent_tools, sorted(self.agents)):
+                if failed_step:
+                    failed_agents[agent_name] = failed_step
+        finally:
+            pool.close()
+            pool.join()
+        return failed_agents
+
+
+    def _test_connectivity(self):
+        ports = self.connectivity_ports
+        hosts = {}
+        for agent_name, attr in self.agents.items():
+            ip_address = attr.get('aws_ip_address') or attr.get('aws_private_ip_address')
+            if ip_address and ip_address!='None':
+                hosts[agent_name] = ip_address
+        if not hosts or not ports:
+            print 'No instances to test.'
+            return
+        print 'Testing connectivity to ports %s of %d instances..'%(', '.join(map(str, ports)), len(hosts))
+        results = probe_ports([(ip_address, port) for ip_address in hosts.values() for port in ports],
+                              timeout=self.input.get('connectivity_timeout') or 5, attempts=self.input.get('connectivity_attempts') or 3)
+        for agent_name, ip_address in sorted(hosts.items()):
+            for port in ports:
+                error = results[(ip_address, port)]
+                if error:
+                    print 'Agent %s (%s): port %d is not reachable: %s'%(agent_name, ip_address, port, error)
+                else:
+                    print 'Agent %s (%s): port %d reachable'%(agent_name, ip_address, port)
+
 
     def process(self):
 
         self.stack_full_id=None
         self.stack_output = {}
 
-        @retry(10,60,1)
         def verify_that_all_agents_connected():
-            for agent_name, attr in self.agents.items():
-                print 'Checking if agent %s is up and running'%agent_name
-                try:
-                    self.client.get_agent_properties(agent_name)
-                except:
-                    print 'Agent %s is not up yet. Recheck in one minute..'%agent_name
-                    raise
-                print 'Agent %s is up and running.'%agent_name
-            pass
+            ## each agent gets its own deadline, counted from the time its instance is running
+            timeout = self.input.get('agent_install_timeout') or 600
+            deadlines = {}
+            for agent_name in self.agents:
+                deadlines[agent_name] = self.agents_running_time.get(agent_name, time.time()) + timeout
+            return AgentReadinessTracker(self.client, deadlines).wait()
 
         try:
-            self._print_step_title('Creating the cloud formation stack..')
+            if self.cf_stacks:
+                self._print_step_title('Creating %d cloud formation stacks..'%len(self.cf_stacks))
+            elif self.update_stack:
+                self._print_step_title('Updating the cloud formation stack..')
+            else:
+                self._print_step_title('Creating the cloud formation stack..')
             additional_params = {}
             if self.cf_capabilities:
                 print 'Capabilities are: {}'.format(self.input['cf_capabilities'])
-                additional_params['capabilities']=self.cf_capabilities
+                additional_params['Capabilities']=self.cf_capabilities
 
             if self.input['cf_parameters']:
-                cf_params = self.input['cf_parameters']
-                if self.cf_globals:
-                    for key,val in cf_params.items():
-                        if val.startswith('cf_globals.'):
-                            new_val = self.cf_globals.get(val[len('cf_globals.'):])
-                            cf_params[key]=new_val
-                additional_params['parameters']=cf_params.items()
+                cf_params = self._resolve_globals(self.input['cf_parameters'])
+                additional_params['Parameters']=[{'ParameterKey': key, 'ParameterValue': val} for key, val in cf_params.items()]
 
             if self.input['cf_tags']:
-                additional_params['tags']=self.input['cf_tags']
+                additional_params['Tags']=[{'Key': key, 'Value': val} for key, val in self.input['cf_tags'].items()]
 
             if self.input.get('disable_rollback'):
-                additional_params['disable_rollback'] = True
+                additional_params['DisableRollback'] = True
 
-            if self.cf_template_url:
-                additional_params['template_url'] = self.cf_template_url
-
-            if self.cf_template:
-                additional_params['template_body'] = json.dumps(self.cf_template)
-
-            self.stack_full_id = self.cf_conn.create_stack(self.input['cf_stack_name'], **additional_params)
-
-
-            if len(self.cf_conn.describe_stacks(self.stack_full_id))==1:
-                print 'Stack created (%s)'%self.stack_full_id
-                self._print_step_title('Waiting for cloud formation initiation to complete (may take few minutes)..')
-                while True:
-                    if self.cf_conn.describe_stacks(self.stack_full_id)[0].stack_status == 'CREATE_COMPLETE':
-                        break
-                    if self.cf_conn.describe_stacks(self.stack_full_id)[0].stack_status in ['CREATE_FAILED', 'ROLLBACK_COMPLETE']:
-                        cf_error = {}
+            if self.cf_stacks:
+                self._create_stacks(additional_params)
+            else:
+                additional_params.update(self.template_params)
+                if self.update_stack:
+                    stack = self._update_stack(additional_params)
+                    if not stack:
+                        return self.client.FAILURE
+                else:
+                    self.stack_full_id = self.cf_client.create_stack(StackName=self.input['cf_stack_name'], **additional_params)['StackId']
+                    if not self.stack_full_id:
+                        raise OperetoRuntimeError('No cloud formation stack found.')
+
+                    print 'Stack created (%s)'%self.stack_full_id
+                    self.metrics.incr('stacks_created')
+                    self._print_step_title('Waiting for cloud formation initiation to complete (may take few minutes)..')
+                    waiter = StackWaiter(self.cf_client, self.stack_full_id)
+                    stack = waiter.wait(CREATE_SUCCESS_STATES, CREATE_FAILURE_STATES)
+                    if stack['StackStatus'] in CREATE_FAILURE_STATES:
                         cf_error_msg=[]
-                        for e in self.cf_conn.describe_stack_events(self.stack_full_id):
-                            cf_error[e.logical_resource_id] = {
-                                'status': e.resource_status,
-                                'reason': e.resource_status_reason
-                            }
-                            error_msg = '%s [%s]: %s'%(e.logical_resource_id, e.resource_status, e.resource_status_reason)
-                            print(error_msg)
-                            cf_error_msg.append(error_msg)
+                        for e in waiter.events:
+                            cf_error_msg.append('%s [%s]: %s'%(e['LogicalResourceId'], e['ResourceStatus'], e.get('ResourceStatusReason')))
+                        print >> sys.stderr, 'Cloud formation stack creation failed (%s).'%stack['StackStatus']
                         self.stack_output['cf_error']='\n'.join(cf_error_msg)
                         return self.client.FAILURE
-                    time.sleep(20)
 
-                print "Cloud formation stack has been created successfully.."
-                outputs = self.cf_conn.describe_stacks(self.stack_full_id)[0].outputs
-                for output_obj in outputs:
-                    self.stack_output[output_obj.key]=output_obj.value
+                    print "Cloud formation stack has been created successfully.."
 
-                self._print_step_title('Waiting that all instances will be up..')
-                wait=False
-                while True:
-                    resources = self.cf_conn.describe_stack_resources(self.stack_full_id)
-                    for resource in resources:
-                        if resource.resource_type=='AWS::EC2::Instance':
-                            reservations = self.ec2_conn.get_all_instances([resource.physical_resource_id])
-                            instance = reservations[0].instances[0]
-                            agent_name = instance.tags.get('OperetoAgentId')
-                            if agent_name:
-                                for k,v in instance.__dict__.items():
-                                    self.agents[agent_name]['aws_'+k]=str(v)
-                                self.agents[agent_name]['aws_region']=self.input['aws_region']
-                            if not str(instance._state).startswith('running'):
-                                wait=True
-                                break
-
-                    if not wait:
-                        break
-                    time.sleep(20)
+                for output_obj in stack.get('Outputs', []):
+                    self.stack_output[output_obj['OutputKey']]=output_obj['OutputValue']
 
+                self._print_step_title('Waiting that all instances will be up..')
+                self._wait_for_instances([(self.stack_full_id, self.input['aws_region'])])
                 print 'All instances are running.'
 
 
@@ -324,84 +819,60 @@ class ServiceRunner(ServiceTemplate):
                 for agent_name, attr in self.agents.items():
                     self.agents[agent_name]['cf_stack_id']=self.stack_full_id
 
-                self._print_step_title('Test SSH connectivity to all instances..')
-                ## test connectivity
-                for agent_name, attr in self.agents.items():
-                    if attr.get('ip_address'):
-                        try:
-                            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                            print 'Testing ssh connectivity to %s'%agent_name
-                            s.connect((attr['ip_address'], 22))
-                            print "Port 22 reachable"
-                            s.close()
-                            time.sleep(2)
-                        except socket.error as e:
-                            print "Error on connect: %s" % e
-                            s.close()
-
-
-                ## check agents installation
-                if self.agents:
-                    self._print_step_title('Verify agents installation and configuration..')
+            self._print_step_title('Test SSH connectivity to all instances..')
+            self._test_connectivity()
 
-                try:
-                    verify_that_all_agents_connected()
-                except:
-                    raise OperetoRuntimeError('One or more agents failed to install. aborting..')
 
-                ## modify agent properties
-                for agent_name, attr in self.agents.items():
-                    try:
-                        self.client.modify_agent_properties(agent_name, attr)
-                    except Exception,e:
-                        print e
-
-                    ## modify agent permissions
-                    permissions = {
-                        'owners': self.users,
-                        'users': self.owners
-                    }
-                    description = attr.get('agent_description') or 'Created by cloud formation stack'
-                    agent_display_name = attr.get('agent_display_name') or agent_name
-                    self.client.modify_agent(agent_name, name=agent_display_name, description=description, permissions=permissions)
+            ## check agents installation
+            if self.agents:
+                self._print_step_title('Verify agents installation and configuration..')
 
-            else:
-                raise OperetoRuntimeError('No cloud formation stack found.')
-
-
-            if self.install_core_tools:
-                install_list=[]
-                for agent_name, attr in self.agents.items():
-                    title = 'Installing opereto worker libraries on agent {}'.format(agent_name)
-                    install_list.append(self.client.create_process(service='install_opereto_worker_libs', agent=agent_name, title=title))
+            failed_agents = verify_that_all_agents_connected()
+            if failed_agents:
+                raise OperetoRuntimeError('One or more agents failed to install (%s). aborting..'%', '.join(failed_agents))
 
-                if not self.client.is_success(install_list):
-                    raise OperetoRuntimeError('Failed to install opereto worker libraries on one or more agents')
-
-                time.sleep(10)
-                if self.install_container_tools:
+            ## modify agent properties
+            for agent_name, attr in self.agents.items():
+                try:
+                    self.client.modify_agent_properties(agent_name, attr)
+                except Exception,e:
+                    print e
 
-                    install_list_2=[]
-                    for agent_name, attr in self.agents.items():
-                        title = 'Installing opereto container tools on agent {}'.format(agent_name)
-                        install_list_2.append(self.client.create_process(service='install_docker_on_host', agent=agent_name, title=title))
+                ## modify agent permissions
+                permissions = {
+                    'owners': self.users,
+                    'users': self.owners
+                }
+                description = attr.get('agent_description') or 'Created by cloud formation stack'
+                agent_display_name = attr.get('agent_display_name') or agent_name
+                self.client.modify_agent(agent_name, name=agent_display_name, description=description, permissions=permissions)
 
-                    if not self.client.is_success(install_list_2):
-                        raise OperetoRuntimeError('Failed to install opereto container tools on one or more agents')
 
-            print 'Cloud formation stack created successfully.'
+            if self.install_core_tools:
+                self._print_step_title('Installing opereto tools on all agents..')
+                failed_agents = self._install_tools()
+                if failed_agents:
+                    for agent_name, title in sorted(failed_agents.items()):
+                        print >> sys.stderr, 'Agent %s: %s failed.'%(agent_name, title)
+                    raise OperetoRuntimeError('Failed to install opereto tools on one or more agents (%s)'%', '.join(sorted(failed_agents)))
+
+            print 'Cloud formation stack %s successfully.'%('updated' if self.update_stack else 'created')
             return self.client.SUCCESS
 
         except Exception, e:
 
             ### TBD: add to service template
-            import re
             err_msg = re.sub("(.{9900})", "\\1\n", str(e), 0, re.DOTALL)
             print >> sys.stderr, 'Cloud formation stack initiation failed : %s.'%err_msg
             self.stack_output['cf_error']=err_msg
-            if self.stack_full_id and not self.input.get('disable_rollback'):
+            if self.stack_full_id and not self.update_stack and not self.input.get('disable_rollback'):
                 print 'Rollback the stack..'
-                print self.cf_conn.delete_stack(self.stack_full_id)
+                self.cf_client.delete_stack(StackName=self.stack_full_id)
+            if self.cf_stacks and not self.input.get('disable_rollback'):
+                for stack in self.stacks:
+                    if stack.get('stack_id'):
+                        print 'Rollback the stack %s..'%stack['cf_stack_name']
+                        self._connect_to_region(stack['aws_region'])[0].delete_stack(StackName=stack['stack_id'])
             return self.client.FAILURE
 
         finally:
@@ -409,7 +880,7 @@ class ServiceRunner(ServiceTemplate):
 
 
     def teardown(self):
-        pass
+        self.metrics.publish(self.client, self.input.get('metrics_file'), pid=self.input.get('pid'))
 
 
 
@@ -1,19 +1,38 @@
-import boto3
 import json
 import os,sys,time
+from multiprocessing.pool import ThreadPool
+from aws_common.clients import get_client
+from aws_common.transfer import TransferSettings, TRANSFER_INPUT_SCHEME, compute_etag, etag_part_sizes
+from aws_common.resumable import ResumableDownload
+from aws_common.archive import archive_format_of, extract_archive
+from aws_common.streaming import BufferLimit, STANDARD_STREAM, STREAM_READ_SIZE, is_stream_path, stream_object
+from aws_common.checksums import ChecksumSummary, EtagHasher, HashingReader
+from aws_common.manifest import MANIFEST_NAME, read_manifest
+from aws_common.metrics import ServiceMetrics
 from opereto.helpers.services import ServiceTemplate
 from opereto.utils.validations import JsonSchemeValidator, validate_dict
 from opereto.exceptions import *
 
+SYNC_MANIFEST_FILE = '.s3_sync_manifest.json'
+
+
 class ServiceRunner(ServiceTemplate):
 
     def __init__(self, **kwargs):
         ServiceTemplate.__init__(self, **kwargs)
 
     def setup(self):
+        self.metrics = ServiceMetrics('aws_get_from_s3')
+        self.checksums = None
+        self.buffers = None
         raise_if_not_ubuntu()
 
 
+    def _print_step_title(self, title):
+        self.metrics.phase(title)
+        ServiceTemplate._print_step_title(self, title)
+
+
     def validate_input(self):
         input_scheme = {
             "type": "object",
@@ -30,6 +49,25 @@ class ServiceRunner(ServiceTemplate):
                      "type" : "string",
                      "minLength": 1
                  },
+                 "max_concurrency": {
+                    "type": "integer",
+                    "minimum": 1
+                 },
+                 "sync": {
+                    "type": "boolean"
+                 },
+                 "resumable": {
+                    "type": "boolean"
+                 },
+                 "extract_archive": {
+                    "type": "boolean"
+                 },
+                 "use_manifest": {
+                    "type": "boolean"
+                 },
+                 "verify_checksums": {
+                    "type": "boolean"
+                 },
                  "aws_access_key": {
                     "type" : "string",
                      "minLength": 1
@@ -38,50 +76,245 @@ class ServiceRunner(ServiceTemplate):
                     "type" : "string",
                      "minLength": 1
                  },
+                 "metrics_file": {
+                     "type" : ["string", "null"]
+                 },
                  "required": ['bucket_name', 'source_path', 'target_path', 'aws_access_key','aws_secret_key'],
                  "additionalProperties": True
             }
         }
+        input_scheme['properties'].update(TRANSFER_INPUT_SCHEME)
         validator = JsonSchemeValidator(self.input, input_scheme)
         validator.validate()
 
         self.source_path = self.input['source_path']
         self.target_path = self.input['target_path']
+        self.max_concurrency = self.input.get('max_concurrency') or 10
+        self.transfer = TransferSettings(self.input)
+        self.sync = self.input.get('sync')
+        self.resumable = self.input.get('resumable')
+        self.use_manifest = self.input.get('use_manifest')
+        if self.input.get('verify_checksums'):
+            if self.transfer.max_bandwidth:
+                raise OperetoRuntimeError('max_bandwidth cannot be applied to verified transfers, unset either max_bandwidth or verify_checksums')
+            self.checksums = ChecksumSummary()
+            self.buffers = BufferLimit()
+        self.manifest_path = os.path.join(self.target_path, SYNC_MANIFEST_FILE)
+        self.manifest = {}
+        self.stream = is_stream_path(self.target_path)
+        if self.stream and (self.input['is_directory'] or self.input.get('extract_archive')):
+            raise OperetoRuntimeError('Only a single object can be streamed to stdout or to a named pipe')
+
+        ## while the object is streamed to stdout, the service output goes to stderr
+        self.output_stream = None
+        if self.target_path == STANDARD_STREAM:
+            sys.stdout.flush()
+            self.output_stream = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+            sys.stdout = sys.stderr
+
+        ## a single client is shared by all download workers, so its connection pool must fit them all
+        self.s3_client = self.metrics.instrument(get_client('s3', self.input['aws_access_key'], self.input['aws_secret_key'],
+                                                            max_pool_connections=self.transfer.pool_connections(self.max_concurrency)))
+
+
+    def _list_source_objects(self):
+        ## one flat listing of the whole prefix
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for result in paginator.paginate(Bucket=self.input['bucket_name'], Prefix=self.source_path):
+            for obj in result.get('Contents') or []:
+                key = obj['Key']
+                if key.endswith('/') or os.path.basename(key) == MANIFEST_NAME:
+                    continue
+                yield key, obj['Size'], obj['ETag'].strip('"')
+
+
+    def _source_objects(self):
+        if self.use_manifest:
+            objects = read_manifest(self.s3_client, self.input['bucket_name'], self.source_path)
+            if objects is not None:
+                print 'Fetching the {} objects listed in the manifest of {}, without listing the prefix..'.format(len(objects), self.source_path)
+                return objects
+            print 'No manifest found under {}, listing its objects..'.format(self.source_path)
+        return self._list_source_objects()
+
+
+    def _scheduled_objects(self, objects):
+        ## parent directories are created once while the keys are scheduled
+        created_dirs = set()
+        for key, size, etag in objects:
+            local_path = self.target_path + os.sep + key
+            local_dir = os.path.dirname(local_path)
+            if local_dir not in created_dirs:
+                if not os.path.isdir(local_dir):
+                    os.makedirs(local_dir)
+                created_dirs.add(local_dir)
+            yield key, local_path, size, etag
+
+
+    def _load_manifest(self):
+        if os.path.isfile(self.manifest_path):
+            try:
+                with open(self.manifest_path) as f:
+                    return json.load(f)
+            except ValueError:
+                print >> sys.stderr, 'Ignoring corrupted sync manifest {}'.format(self.manifest_path)
+        return {}
+
+
+    def _save_manifest(self, manifest):
+        if not os.path.isdir(self.target_path):
+            os.makedirs(self.target_path)
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp_path, self.manifest_path)
+
+
+    def _is_unchanged(self, key, local_path, size, etag):
+        if not os.path.isfile(local_path):
+            return False
+        stat = os.stat(local_path)
+        if stat.st_size != size:
+            return False
+        ## the manifest tells whether this exact local file was already matched with this etag, so it is not re-hashed
+        entry = self.manifest.get(key)
+        if entry and entry['etag'] == etag and entry['mtime'] == stat.st_mtime:
+            return True
+        for part_size in etag_part_sizes(size, etag, self.transfer):
+            if compute_etag(local_path, part_size) == etag:
+                return True
+        return False
+
+
+    def _fetch_verified_object(self, key, local_path):
+        ## fetched in order to a temp file and hashed while written, the file is renamed into place once verified
+        tmp_path = '%s.%d.tmp' % (local_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                stream_object(self.s3_client, self.input['bucket_name'], key, f, self.transfer, checksums=self.checksums, buffers=self.buffers)
+            os.rename(tmp_path, local_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+    def _fetch_object(self, key, local_path, size):
+        if self.resumable and size >= self.transfer.threshold():
+            ## resumable downloads verify the completed file against the object etag whenever it is md5 based
+            download = ResumableDownload(self.s3_client, self.input['bucket_name'], key, local_path, self.transfer)
+            download.download()
+            if self.checksums:
+                if download.verified:
+                    self.checksums.add_verified()
+                else:
+                    self.checksums.add_unverified()
+        elif self.checksums:
+            self._fetch_verified_object(key, local_path)
+        else:
+            self.s3_client.download_file(self.input['bucket_name'], key, local_path, Config=self.transfer.config(size))
+        self.metrics.incr('files_transferred')
+        self.metrics.incr('bytes_transferred', size)
+
+
+    def _download_file(self, item):
+        key, local_path, size, etag = item
+        try:
+            if self.sync and self._is_unchanged(key, local_path, size, etag):
+                return item, False, None
+            self._fetch_object(key, local_path, size)
+        except Exception, e:
+            return item, False, str(e)
+        return item, True, None
+
+
+    def _download_files(self, objects):
+        downloaded = 0
+        skipped = 0
+        failures = {}
+        manifest = {}
+        pool = ThreadPool(self.max_concurrency)
+        try:
+            for (key, local_path, size, etag), is_downloaded, error in pool.imap_unordered(self._download_file, objects):
+                if error:
+                    failures[key] = error
+                    continue
+                if is_downloaded:
+                    downloaded += 1
+                else:
+                    skipped += 1
+                manifest[key] = {'etag': etag, 'size': size, 'mtime': os.stat(local_path).st_mtime}
+        finally:
+            pool.close()
+            pool.join()
+        return downloaded, skipped, failures, manifest
+
+
+    def _stream_object(self):
+        target_name = 'stdout' if self.output_stream else 'named pipe {}'.format(self.target_path)
+        print 'Streaming the content of {} from bucket {} to {}..'.format(self.source_path, self.input['bucket_name'], target_name)
+        ## opening a named pipe blocks until its reader is connected
+        target = self.output_stream or open(self.target_path, 'wb')
+        try:
+            size = stream_object(self.s3_client, self.input['bucket_name'], self.source_path, target, self.transfer, checksums=self.checksums)
+        finally:
+            target.close()
+        self.metrics.incr('files_transferred')
+        self.metrics.incr('bytes_transferred', size)
+        print '{} bytes streamed.'.format(size)
 
-        self.session = boto3.session.Session(
-            aws_access_key_id=self.input['aws_access_key'],
-            aws_secret_access_key=self.input['aws_secret_key']
-        )
-        self.s3_client = self.session.client('s3')
-        self.s3_res = self.session.resource('s3')
 
     def process(self):
 
-        def download_dir(client, resource, dist, local, bucket):
-            paginator = client.get_paginator('list_objects')
-            for result in paginator.paginate(Bucket=bucket, Delimiter='/', Prefix=dist):
-                if result.get('CommonPrefixes') is not None:
-                    for subdir in result.get('CommonPrefixes'):
-                        download_dir(client, resource, subdir.get('Prefix'), local, bucket)
-                if result.get('Contents') is not None:
-                    for file in result.get('Contents'):
-                        if not os.path.exists(os.path.dirname(local + os.sep + file.get('Key'))):
-                             os.makedirs(os.path.dirname(local + os.sep + file.get('Key')))
-                        resource.meta.client.download_file(bucket, file.get('Key'), local + os.sep + file.get('Key'))
-
-
-        if self.input['is_directory']:
-            print 'Fetching the content of {} recursively from bucket {} to directory {}..'.format(self.source_path, self.input['bucket_name'], self.target_path)
-            download_dir(self.s3_client, self.s3_res, self.source_path, self.target_path, self.input['bucket_name'])
+        self._print_step_title('Copying s3 data to local storage..')
+        if self.stream:
+            self._stream_object()
+        elif self.input.get('extract_archive'):
+            archive_format = archive_format_of(self.source_path)
+            print 'Extracting the {} archive {} from bucket {} to directory {}..'.format(archive_format, self.source_path, self.input['bucket_name'], self.target_path)
+            if not os.path.isdir(self.target_path):
+                os.makedirs(self.target_path)
+            response = self.s3_client.get_object(Bucket=self.input['bucket_name'], Key=self.source_path)
+            body = response['Body']
+            if self.checksums:
+                hasher = EtagHasher(response['ContentLength'], response['ETag'], self.transfer)
+                body = HashingReader(body, hasher)
+            files = extract_archive(body, self.target_path, archive_format)
+            if self.checksums:
+                ## the archive end may not be read by the extraction, it is hashed as well
+                while body.read(STREAM_READ_SIZE):
+                    pass
+                self.checksums.check(self.source_path, hasher, response)
+            self.metrics.incr('files_transferred', files)
+            self.metrics.incr('bytes_transferred', response['ContentLength'])
+            print '{} files extracted.'.format(files)
+        elif self.input['is_directory']:
+            print 'Fetching the content of {} recursively from bucket {} to directory {} ({} parallel downloads)..'.format(self.source_path, self.input['bucket_name'], self.target_path, self.max_concurrency)
+            if self.sync:
+                print 'Sync mode: skipping files already matching the stored objects..'
+                self.manifest = self._load_manifest()
+            downloaded, skipped, failures, manifest = self._download_files(self._scheduled_objects(self._source_objects()))
+            print '{} files downloaded, {} unchanged files skipped.'.format(downloaded, skipped)
+            if self.sync:
+                self._save_manifest(manifest)
+            if failures:
+                for key, error in sorted(failures.items()):
+                    print >> sys.stderr, 'Failed to download {}: {}'.format(key, error)
+                print >> sys.stderr, '{} files failed to download.'.format(len(failures))
+                return self.client.FAILURE
         else:
             print 'Fetching the content of {} from bucket {} to local file {}..'.format(self.source_path, self.input['bucket_name'], self.target_path)
-            self.s3_res.meta.client.download_file(self.input['bucket_name'], self.source_path, self.target_path)
+            print 'Transfer settings: {}'.format(self.transfer)
+            size = self.s3_client.head_object(Bucket=self.input['bucket_name'], Key=self.source_path)['ContentLength']
+            self._fetch_object(self.source_path, self.target_path, size)
 
         print 'Operation completed successfuly.'
         return self.client.SUCCESS
 
     def teardown(self):
-        pass
+        if self.checksums:
+            self.checksums.publish(self.client)
+        self.metrics.publish(self.client, self.input.get('metrics_file'), pid=self.input.get('pid'))
 
 
 
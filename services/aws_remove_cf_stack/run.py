@@ -1,7 +1,8 @@
-import boto
-import boto.cloudformation
-import time
 import sys
+from botocore.exceptions import ClientError
+from aws_common.clients import get_client, error_code
+from aws_common.stack_waiter import StackWaiter, MultiStackWaiter, DELETE_SUCCESS_STATES, DELETE_FAILURE_STATES
+from aws_common.metrics import ServiceMetrics
 from opereto.helpers.services import ServiceTemplate
 from opereto.utils.validations import JsonSchemeValidator
 from opereto.exceptions import *
@@ -12,16 +13,34 @@ class ServiceRunner(ServiceTemplate):
         ServiceTemplate.__init__(self, **kwargs)
 
     def setup(self):
+        self.metrics = ServiceMetrics('aws_remove_cf_stack')
         raise_if_not_ubuntu()
 
 
+    def _print_step_title(self, title):
+        self.metrics.phase(title)
+        ServiceTemplate._print_step_title(self, title)
+
+
     def validate_input(self):
         input_scheme = {
             "type": "object",
             "properties" : {
                  "cf_stack_name": {
-                     "type" : "string",
-                     "minLength": 1
+                     "type" : ["string", "null"]
+                 },
+                 "cf_stack_names": {
+                     "type" : ["array", "null"],
+                     "items": {
+                         "type": "string",
+                         "minLength": 1
+                     }
+                 },
+                 "cf_stack_prefix": {
+                     "type" : ["string", "null"]
+                 },
+                 "cf_stack_tags": {
+                     "type" : ["object", "null"]
                  },
                  "aws_access_key": {
                     "type" : "string",
@@ -35,7 +54,10 @@ class ServiceRunner(ServiceTemplate):
                     "type" : "string",
                      "minLength": 1
                  },
-                 "required": ['cf_stack_name', 'aws_access_key','aws_secret_key', 'aws_region'],
+                 "metrics_file": {
+                     "type" : ["string", "null"]
+                 },
+                 "required": ['aws_access_key','aws_secret_key', 'aws_region'],
                  "additionalProperties": True
             }
         }
@@ -43,43 +65,135 @@ class ServiceRunner(ServiceTemplate):
         validator.validate()
 
         self.cf_stack_name = self.input['cf_stack_name']
+        self.cf_stack_names = set(self.input.get('cf_stack_names') or [])
+        if self.cf_stack_name:
+            self.cf_stack_names.add(self.cf_stack_name)
+        self.cf_stack_prefix = self.input.get('cf_stack_prefix')
+        self.cf_stack_tags = self.input.get('cf_stack_tags')
+        if not self.cf_stack_names and not self.cf_stack_prefix and not self.cf_stack_tags:
+            raise OperetoRuntimeError('A stack name, a list of stack names, a stack name prefix or stack tags must be provided.')
         self.aws_access_key = self.input['aws_access_key']
         self.aws_secret_key = self.input['aws_secret_key']
         self.aws_region = self.input['aws_region']
 
         self._print_step_title('Connecting to AWS..')
-        self.cf_conn = boto.cloudformation.connect_to_region(self.input['aws_region'], aws_access_key_id=self.input['aws_access_key'],
-                                                        aws_secret_access_key=self.input['aws_secret_key'])
+        self.cf_client = self.metrics.instrument(get_client('cloudformation', self.aws_access_key, self.aws_secret_key, self.aws_region))
         print 'Connected.'
 
-    def process(self):
-
-
+    def _is_selected(self, stack):
+        if stack['StackName'] in self.cf_stack_names:
+            return True
+        if not self.cf_stack_prefix and not self.cf_stack_tags:
+            return False
+        ## nested stacks share the name prefix and tags of their root stack, they are deleted with it
+        if stack.get('ParentId') or stack.get('RootId'):
+            return False
+        if self.cf_stack_prefix and not stack['StackName'].startswith(self.cf_stack_prefix):
+            return False
+        if self.cf_stack_tags:
+            tags = dict([(tag['Key'], tag['Value']) for tag in stack.get('Tags') or []])
+            for key, value in self.cf_stack_tags.items():
+                if tags.get(key)!=value:
+                    return False
+        return True
+
+
+    def _describe_named_stacks(self):
+        stacks = {}
+        for stack_name in sorted(self.cf_stack_names):
+            try:
+                stack = self.cf_client.describe_stacks(StackName=stack_name)['Stacks'][0]
+            except ClientError, e:
+                if error_code(e)=='ValidationError' and 'does not exist' in e.response['Error'].get('Message', ''):
+                    continue
+                raise
+            stacks[stack['StackName']] = stack['StackId']
+        return stacks
+
+
+    def _find_stacks(self):
+        ## stacks given by name only are described directly, otherwise a single paged listing of the region stacks
+        ## resolves names, prefix and tags together
+        if not self.cf_stack_prefix and not self.cf_stack_tags:
+            return self._describe_named_stacks()
+        stacks = {}
+        next_token = None
+        while True:
+            params = {'NextToken': next_token} if next_token else {}
+            page = self.cf_client.describe_stacks(**params)
+            for stack in page['Stacks']:
+                if self._is_selected(stack):
+                    stacks[stack['StackName']] = stack['StackId']
+            next_token = page.get('NextToken')
+            if not next_token:
+                break
+        return stacks
+
+
+    def _remove_stack(self, stack_name, stack_id):
+        waiter = StackWaiter(self.cf_client, stack_id)
         try:
             self._print_step_title('Deleting the topology stack (may take few minutes)...')
-            print self.cf_conn.delete_stack(self.input['cf_stack_name'])
+            ## only the events of the deletion are printed, not the whole history of the stack
+            waiter.skip_existing_events()
+            self.cf_client.delete_stack(StackName=stack_id)
         except Exception, e:
             print >> sys.stderr, 'Topology deletion failed : %s.'%str(e)
             print >> sys.stderr, 'Please retry again later or delete the stack directly from AWS cloud formation console.'
             return self.client.FAILURE
 
         self._print_step_title('Verifying that the stack is deleted..')
-        print 'Verifying that the stack is deleted..'
-        while True:
+        stack = waiter.wait(DELETE_SUCCESS_STATES, DELETE_FAILURE_STATES)
+        if stack['StackStatus'] in DELETE_FAILURE_STATES:
+            print >> sys.stderr, 'Cloud formation stack deletion failed: %s'%stack.get('StackStatusReason')
+            return self.client.FAILURE
+        print 'Cloud formation stack has been deleted successfully.'
+        return self.client.SUCCESS
+
+
+    def _remove_stacks(self, stacks):
+        ## all deletions are issued at once and tracked together by a single status poll
+        self._print_step_title('Deleting %d stacks (may take few minutes)...'%len(stacks))
+        waiter = MultiStackWaiter()
+        failed_stacks = {}
+        for stack_name, stack_id in sorted(stacks.items()):
             try:
-                print self.cf_conn.describe_stacks(self.input['cf_stack_name'])[0].stack_status
-                time.sleep(30)
+                self.cf_client.delete_stack(StackName=stack_id)
+                waiter.add(self.aws_region, self.cf_client, stack_id, stack_name, DELETE_SUCCESS_STATES, DELETE_FAILURE_STATES)
             except Exception, e:
-                if '%s does not exist'%self.input['cf_stack_name'] in str(e):
-                    break
-                else:
-                    print str(e)
-                    return self.client.FAILURE
-        print 'Cloud formation stack has been deleted successfully.'
+                failed_stacks[stack_name] = str(e)
+
+        self._print_step_title('Verifying that the stacks are deleted..')
+        statuses = waiter.wait()
+        for stack_id, status in statuses.items():
+            if status in DELETE_FAILURE_STATES:
+                failed_stacks[waiter.stacks[stack_id]['name']] = waiter.stacks[stack_id]['reason'] or status
+
+        for stack_name, error in sorted(failed_stacks.items()):
+            print >> sys.stderr, 'Deletion of stack %s failed: %s'%(stack_name, error)
+        if failed_stacks:
+            print >> sys.stderr, 'Please retry again later or delete the stacks directly from AWS cloud formation console.'
+            return self.client.FAILURE
+        print '%d cloud formation stacks have been deleted successfully.'%len(stacks)
         return self.client.SUCCESS
 
+
+    def process(self):
+
+        stacks = self._find_stacks()
+        for stack_name in sorted(self.cf_stack_names - set(stacks)):
+            print 'Cloud formation stack %s does not exist.'%stack_name
+        if not stacks:
+            print 'No cloud formation stacks to delete.'
+            return self.client.SUCCESS
+        print 'Stacks to delete: %s'%', '.join(sorted(stacks))
+
+        if len(stacks)==1:
+            return self._remove_stack(*stacks.items()[0])
+        return self._remove_stacks(stacks)
+
     def teardown(self):
-        pass
+        self.metrics.publish(self.client, self.input.get('metrics_file'), pid=self.input.get('pid'))
 
 
 
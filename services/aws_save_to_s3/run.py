@@ -1,19 +1,73 @@
-import boto3
+import calendar
+import gzip
 import json
+import mimetypes
 import os,sys,time
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
+from aws_common.clients import get_client
+from aws_common.transfer import TransferSettings, TRANSFER_INPUT_SCHEME, compute_etag, etag_part_sizes
+from aws_common.streaming import BufferLimit, MultipartUploadWriter, STANDARD_STREAM, is_stream_path, copy_stream
+from aws_common.archive import ARCHIVE_FORMATS, write_archive
+from aws_common.manifest import manifest_key, write_manifest
+from aws_common.checksums import ChecksumSummary
+from aws_common.metrics import ServiceMetrics
 from opereto.helpers.services import ServiceTemplate
 from opereto.utils.validations import JsonSchemeValidator, validate_dict
 from opereto.exceptions import *
 
+SYNC_COMPARE_MODES = ['size_mtime', 'checksum']
+COMPRESSIBLE_CONTENT_TYPES = ['application/javascript', 'application/json', 'application/xml', 'image/svg+xml']
+
+mimetypes.add_type('application/javascript', '.js')
+mimetypes.add_type('application/json', '.json')
+mimetypes.add_type('image/svg+xml', '.svg')
+mimetypes.add_type('application/font-woff', '.woff')
+mimetypes.add_type('font/woff2', '.woff2')
+
+_content_types = {}
+
+
+def content_type_of(path, default):
+    ## mime types are looked up once per file extension
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in _content_types:
+        _content_types[ext] = mimetypes.guess_type('file' + ext, strict=False)[0]
+    return _content_types[ext] or default
+
+
+def is_compressible(content_type):
+    return content_type.startswith('text/') or content_type in COMPRESSIBLE_CONTENT_TYPES
+
+
+def gzip_file(path):
+    ## the gzip header timestamp is fixed so that unchanged files always compress to the same bytes (see sync mode)
+    fd, gzip_path = tempfile.mkstemp(suffix='.gz')
+    with os.fdopen(fd, 'wb') as f, open(path, 'rb') as source:
+        gz = gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=0)
+        shutil.copyfileobj(source, gz)
+        gz.close()
+    return gzip_path
+
+
 class ServiceRunner(ServiceTemplate):
 
     def __init__(self, **kwargs):
         ServiceTemplate.__init__(self, **kwargs)
 
     def setup(self):
+        self.metrics = ServiceMetrics('aws_save_to_s3')
+        self.checksums = None
+        self.buffers = None
         raise_if_not_ubuntu()
 
 
+    def _print_step_title(self, title):
+        self.metrics.phase(title)
+        ServiceTemplate._print_step_title(self, title)
+
+
     def validate_input(self):
         input_scheme = {
             "type": "object",
@@ -41,6 +95,37 @@ class ServiceRunner(ServiceTemplate):
                  "content_type": {
                     "type": "string"
                  },
+                 "max_concurrency": {
+                    "type": "integer",
+                    "minimum": 1
+                 },
+                 "sync": {
+                    "type": "boolean"
+                 },
+                 "sync_compare": {
+                    "enum": SYNC_COMPARE_MODES
+                 },
+                 "sync_delete": {
+                    "type": "boolean"
+                 },
+                 "detect_content_type": {
+                    "type": "boolean"
+                 },
+                 "compress_text": {
+                    "type": "boolean"
+                 },
+                 "cache_control": {
+                    "type": ["string", "null"]
+                 },
+                 "write_manifest": {
+                    "type": "boolean"
+                 },
+                 "verify_checksums": {
+                    "type": "boolean"
+                 },
+                 "archive_format": {
+                    "enum": [None, ''] + ARCHIVE_FORMATS.keys()
+                 },
                  "aws_access_key": {
                     "type" : "string",
                      "minLength": 1
@@ -49,23 +134,227 @@ class ServiceRunner(ServiceTemplate):
                     "type" : "string",
                      "minLength": 1
                  },
+                 "metrics_file": {
+                     "type" : ["string", "null"]
+                 },
                  "required": ['bucket_name', 'source_path', 'target_path', 'aws_access_key','aws_secret_key', 'content_type'],
                  "additionalProperties": True
             }
         }
+        input_scheme['properties'].update(TRANSFER_INPUT_SCHEME)
         validator = JsonSchemeValidator(self.input, input_scheme)
         validator.validate()
 
 
         self.source_path = self.input['source_path']
         self.target_path = self.input['target_path'].lstrip('/')
+        self.max_concurrency = self.input.get('max_concurrency') or 10
+        self.transfer = TransferSettings(self.input)
+        self.sync = self.input.get('sync')
+        self.sync_compare = self.input.get('sync_compare') or 'size_mtime'
+        self.sync_delete = self.input.get('sync_delete')
+        self.archive_format = self.input.get('archive_format')
+        self.detect_content_type = self.input.get('detect_content_type', True)
+        self.compress_text = self.input.get('compress_text')
+        self.cache_control = self.input.get('cache_control')
+        self.write_manifest = self.input.get('write_manifest')
+        if self.input.get('verify_checksums'):
+            if self.transfer.max_bandwidth:
+                raise OperetoRuntimeError('max_bandwidth cannot be applied to verified transfers, unset either max_bandwidth or verify_checksums')
+            self.checksums = ChecksumSummary()
+            self.buffers = BufferLimit()
+        self.target_objects = {}
+        self.content_types = {}
+        self.stream = is_stream_path(self.source_path)
+        if self.stream and (not self.target_path or self.target_path.endswith('/')):
+            raise OperetoRuntimeError('A target object key must be provided when saving a stream')
+
+        ## a single client is shared by all upload workers, so its connection pool must fit them all
+        self.s3_client = self.metrics.instrument(get_client('s3', self.input['aws_access_key'], self.input['aws_secret_key'],
+                                                            max_pool_connections=self.transfer.pool_connections(self.max_concurrency)))
 
-        self.session = boto3.session.Session(
-            aws_access_key_id=self.input['aws_access_key'],
-            aws_secret_access_key=self.input['aws_secret_key']
-        )
-        self.s3_client = self.session.client('s3')
-        self.s3_res = self.session.resource('s3')
+
+    def _target_prefix(self):
+        main_root_dir=os.path.basename(os.path.normpath(self.source_path))
+        if self.target_path:
+            return '%s/%s/' % (self.target_path.rstrip('/'), main_root_dir)
+        return '%s/' % main_root_dir
+
+
+    def _list_target_objects(self, prefix):
+        objects = {}
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for result in paginator.paginate(Bucket=self.input['bucket_name'], Prefix=prefix):
+            for obj in result.get('Contents') or []:
+                objects[obj['Key']] = {
+                    'size': obj['Size'],
+                    'etag': obj['ETag'].strip('"'),
+                    'mtime': calendar.timegm(obj['LastModified'].utctimetuple())
+                }
+        return objects
+
+
+    def _is_unchanged(self, local_path, upload_path, target_id):
+        ## upload_path holds the bytes to be stored (the local file or its compressed copy)
+        remote = self.target_objects.get(target_id)
+        if not remote:
+            return False
+        size = os.path.getsize(upload_path)
+        if size != remote['size']:
+            return False
+        if self.sync_compare == 'checksum':
+            for part_size in etag_part_sizes(size, remote['etag'], self.transfer):
+                if compute_etag(upload_path, part_size) == remote['etag']:
+                    return True
+            return False
+        return int(os.path.getmtime(local_path)) <= remote['mtime']
+
+
+    def _delete_extraneous_objects(self, source_ids):
+        extraneous = sorted(set(self.target_objects.keys()) - set(source_ids))
+        for i in range(0, len(extraneous), 1000):
+            response = self.s3_client.delete_objects(Bucket=self.input['bucket_name'], Delete={
+                'Objects': [{'Key': key} for key in extraneous[i:i+1000]],
+                'Quiet': True
+            })
+            for error in response.get('Errors') or []:
+                print >> sys.stderr, 'Failed to delete {}: {}'.format(error['Key'], error['Message'])
+        return len(extraneous)
+
+
+    def _save_manifest(self, source_ids):
+        ## the etags of the stored objects are read back with a single listing rather than a request per object
+        prefix = self._target_prefix()
+        stored = self._list_target_objects(prefix)
+        objects = [{
+            'key': target_id,
+            'size': stored[target_id]['size'],
+            'etag': stored[target_id]['etag'],
+            'content_type': self.content_types[target_id]
+        } for target_id in source_ids if target_id in stored]
+        key = write_manifest(self.s3_client, self.input['bucket_name'], prefix, objects, extra_args={'ACL': self.acl},
+                             url_expiry=self.input['presigned_url_expiry'])
+        print 'Manifest of {} objects saved to {}.'.format(len(objects), key)
+        return key
+
+
+    def _save_archive(self):
+        main_root_dir=os.path.basename(os.path.normpath(self.source_path))
+        if not self.target_path or self.target_path.endswith('/'):
+            self.target_path = '%s%s.%s' % (self.target_path, main_root_dir, self.archive_format)
+        print 'Streaming the content of directory {} as {} archive to {} in bucket {}..'.format(self.source_path, self.archive_format, self.target_path, self.input['bucket_name'])
+        writer = MultipartUploadWriter(self.s3_client, self.input['bucket_name'], self.target_path, self.transfer,
+                                       extra_args={'ACL': self.acl, 'ContentType': ARCHIVE_FORMATS[self.archive_format]},
+                                       checksums=self.checksums)
+        try:
+            files = write_archive(self.source_path, main_root_dir, writer, self.archive_format)
+        except:
+            writer.abort()
+            raise
+        writer.close()
+        self.metrics.incr('files_transferred', files)
+        self.metrics.incr('bytes_transferred', writer.bytes_written)
+        print '{} files archived ({} bytes uploaded).'.format(files, writer.bytes_written)
+
+
+    def _save_stream(self):
+        ## uploads stdin or a named pipe in multipart chunks, without staging the data on disk
+        source_name = 'stdin' if self.source_path == STANDARD_STREAM else 'named pipe {}'.format(self.source_path)
+        print 'Streaming {} to {} in bucket {}..'.format(source_name, self.target_path, self.input['bucket_name'])
+        writer = MultipartUploadWriter(self.s3_client, self.input['bucket_name'], self.target_path, self.transfer,
+                                       extra_args=self._extra_args(self.input['content_type']), checksums=self.checksums)
+        source = sys.stdin if self.source_path == STANDARD_STREAM else open(self.source_path, 'rb')
+        try:
+            copy_stream(source, writer)
+        except:
+            writer.abort()
+            raise
+        finally:
+            if source is not sys.stdin:
+                source.close()
+        writer.close()
+        self.metrics.incr('files_transferred')
+        self.metrics.incr('bytes_transferred', writer.bytes_written)
+        print '{} bytes uploaded.'.format(writer.bytes_written)
+
+
+    def _list_source_files(self):
+        ## keys are relative to the source directory, under the same prefix the sync mode and the manifest use
+        target_prefix = self._target_prefix()
+        for root, dirs, files in os.walk(self.source_path):
+            for name in files:
+                local_path = os.path.join(root, name)
+                relative_path = os.path.relpath(local_path, self.source_path)
+                yield local_path, target_prefix + '/'.join(relative_path.split(os.path.sep))
+
+
+    def _extra_args(self, content_type):
+        extra_args = {'ACL': self.acl, 'ContentType': content_type}
+        if self.cache_control:
+            extra_args['CacheControl'] = self.cache_control
+        return extra_args
+
+
+    def _put_file(self, path, target_id, extra_args, size):
+        if not self.checksums:
+            self.s3_client.upload_file(path, self.input['bucket_name'], target_id, ExtraArgs=extra_args, Config=self.transfer.config(size))
+            return
+        ## the file is read once, in order, each part is verified by its md5 while it is uploaded. The buffered parts of all
+        ## the parallel uploads share one memory limit
+        writer = MultipartUploadWriter(self.s3_client, self.input['bucket_name'], target_id, self.transfer, extra_args=extra_args,
+                                       file_size=size, checksums=self.checksums, buffers=self.buffers)
+        with open(path, 'rb') as f:
+            try:
+                copy_stream(f, writer)
+            except:
+                writer.abort()
+                raise
+        writer.close()
+
+
+    def _upload_file(self, item):
+        local_path, target_id = item
+        upload_path = local_path
+        try:
+            content_type = self.input['content_type']
+            if self.detect_content_type:
+                content_type = content_type_of(local_path, content_type)
+            self.content_types[target_id] = content_type
+            extra_args = self._extra_args(content_type)
+            if self.compress_text and is_compressible(content_type):
+                upload_path = gzip_file(local_path)
+                extra_args['ContentEncoding'] = 'gzip'
+            if self.sync and self._is_unchanged(local_path, upload_path, target_id):
+                return target_id, False, None
+            size = os.path.getsize(upload_path)
+            self._put_file(upload_path, target_id, extra_args, size)
+            self.metrics.incr('files_transferred')
+            self.metrics.incr('bytes_transferred', size)
+        except Exception, e:
+            return target_id, False, str(e)
+        finally:
+            if upload_path != local_path:
+                os.remove(upload_path)
+        return target_id, True, None
+
+
+    def _upload_files(self, files):
+        uploaded = 0
+        skipped = 0
+        failures = {}
+        pool = ThreadPool(self.max_concurrency)
+        try:
+            for target_id, is_uploaded, error in pool.imap_unordered(self._upload_file, files):
+                if error:
+                    failures[target_id] = error
+                elif is_uploaded:
+                    uploaded += 1
+                else:
+                    skipped += 1
+        finally:
+            pool.close()
+            pool.join()
+        return uploaded, skipped, failures
 
 
     def process(self):
@@ -85,30 +374,51 @@ class ServiceRunner(ServiceTemplate):
         time.sleep(1)  ## for logs to appear in right order
         self._print_step_title('Copying local data to s3..')
 
-        if not os.path.exists(self.input['source_path']):
+        if not self.stream and not os.path.exists(self.input['source_path']):
             raise OperetoRuntimeError('Source path does not exist')
 
-        if os.path.isdir(self.input['source_path']):
-            print 'Saving the content of directory {} to {} in bucket {}..'.format(self.source_path, self.target_path, self.input['bucket_name'])
-
-            main_root_dir=os.path.basename(os.path.normpath(self.source_path))
-            for root, dirs, files in os.walk(self.source_path):
-                for name in files:
-                    path = root[root.find(main_root_dir):].split(os.path.sep)
-                    path.append(name)
-                    target_id = '/'.join(path)
-                    if self.target_path:
-                        target_id = '%s/%s' % (self.target_path, target_id)
-                    self.s3_res.meta.client.upload_file(os.path.join(root, name), self.input['bucket_name'], target_id, ExtraArgs={'ACL':self.acl, 'ContentType': self.input['content_type']})
+        manifest_id = None
+
+        if self.stream:
+            self._save_stream()
+        elif os.path.isdir(self.input['source_path']) and self.archive_format:
+            self._save_archive()
+        elif os.path.isdir(self.input['source_path']):
+            print 'Saving the content of directory {} to {} in bucket {} ({} parallel uploads)..'.format(self.source_path, self.target_path, self.input['bucket_name'], self.max_concurrency)
+            source_files = list(self._list_source_files())
+            if self.sync:
+                print 'Sync mode: comparing local files with existing objects by {}..'.format(self.sync_compare)
+                self.target_objects = self._list_target_objects(self._target_prefix())
+            uploaded, skipped, failures = self._upload_files(source_files)
+            print '{} files uploaded, {} unchanged files skipped.'.format(uploaded, skipped)
+            if failures:
+                for target_id, error in sorted(failures.items()):
+                    print >> sys.stderr, 'Failed to upload {}: {}'.format(target_id, error)
+                print >> sys.stderr, '{} files failed to upload.'.format(len(failures))
+                return self.client.FAILURE
+            source_ids = [target_id for local_path, target_id in source_files]
+            if self.sync and self.sync_delete:
+                ## the manifest is rewritten below, so it is not extraneous
+                kept_ids = source_ids + [manifest_key(self._target_prefix())] if self.write_manifest else source_ids
+                deleted = self._delete_extraneous_objects(kept_ids)
+                print '{} extraneous objects deleted.'.format(deleted)
+            if self.write_manifest:
+                manifest_id = self._save_manifest(source_ids)
         else:
             print 'Saving local file {} to {} in bucket {}..'.format(self.source_path, self.target_path, self.input['bucket_name'])
-            self.s3_res.meta.client.upload_file(self.source_path, self.input['bucket_name'], self.target_path, ExtraArgs={'ACL':self.acl, 'ContentType': self.input['content_type']})
+            print 'Transfer settings: {}'.format(self.transfer)
+            size = os.path.getsize(self.source_path)
+            self._put_file(self.source_path, self.target_path, self._extra_args(self.input['content_type']), size)
+            self.metrics.incr('files_transferred')
+            self.metrics.incr('bytes_transferred', size)
 
         print 'Operation completed successfuly.'
 
+        ## set after the transfer, the archive mode names the target after the source directory
+        url_key = manifest_id or self.target_path
         if self.input['presigned_url_expiry']:
             print 'Generating pre-signed url expired in {} seconds..'.format(self.input['presigned_url_expiry'])
-            presigned_url = self.s3_client.generate_presigned_url('get_object', Params={'Bucket': self.input['bucket_name'], 'Key': self.target_path}, ExpiresIn=self.input['presigned_url_expiry'])
+            presigned_url = self.s3_client.generate_presigned_url('get_object', Params={'Bucket': self.input['bucket_name'], 'Key': url_key}, ExpiresIn=self.input['presigned_url_expiry'])
             print '[OPERETO_HTML]<a target="_blank" href="' + presigned_url + '">'+ presigned_url +'</a>'
             print '\n\n'
             self.client.modify_process_property('storage_url', presigned_url)
@@ -116,7 +426,9 @@ class ServiceRunner(ServiceTemplate):
         return self.client.SUCCESS
 
     def teardown(self):
-        pass
+        if self.checksums:
+            self.checksums.publish(self.client)
+        self.metrics.publish(self.client, self.input.get('metrics_file'), pid=self.input.get('pid'))
 
 
 